@@ -1,8 +1,8 @@
+from bitcoin_protocol.codec import UINT32
 from bitcoin_protocol.helper import (
     bits_to_target,
     hash256,
     merkle_root,
-    int_to_little_endian,
     little_endian_to_int,
 )
 
@@ -33,38 +33,53 @@ class Block:
         """Takes a byte stream and parses the block header at the start
         return a Block object
         """
+        return cls.parse_from(stream.read(80))[0]
 
+    @classmethod
+    def parse_from(cls, buffer, offset=0):
+        """Parses the block header at offset of buffer, returns it and the
+        offset right after it
+        """
         # version is an integer in 4 bytes, little-endian
-        version = little_endian_to_int(stream.read(4))
+        version = UINT32.unpack_from(buffer, offset)[0]
         # previous block is a 32 bytes little-endian reversed with [::-1]
-        prev_block = stream.read(32)[::-1]
+        prev_block = bytes(buffer[offset + 4 : offset + 36])[::-1]
         # merkle root is a 32 bytes little-endian reversed with [::-1]
-        merkle_root = stream.read(32)[::-1]
+        merkle_root = bytes(buffer[offset + 36 : offset + 68])[::-1]
         # timestamp is an integer in 4 bytes, little-endian,
-        timestamp = little_endian_to_int(stream.read(4))
+        timestamp = UINT32.unpack_from(buffer, offset + 68)[0]
         # bits is a 4 bytes
-        bits = stream.read(4)
+        bits = bytes(buffer[offset + 72 : offset + 76])
         # nonce is a 4 bytes
-        nonce = stream.read(4)
+        nonce = bytes(buffer[offset + 76 : offset + 80])
 
-        return cls(version, prev_block, merkle_root, timestamp, bits, nonce)
+        return (
+            cls(version, prev_block, merkle_root, timestamp, bits, nonce),
+            offset + 80,
+        )
 
-    def serialize(self):
-        """Returns the 80 byte block header"""
+    def serialize_into(self, buffer, offset):
+        """Writes the 80 byte block header at offset of buffer, returns the
+        offset right after it"""
         # version is an integer in 4 bytes, little-endian
-        result = int_to_little_endian(self.version, 4)
+        UINT32.pack_into(buffer, offset, self.version)
         # previous block is an integer in 32 bytes, little-endian
-        result += self.prev_block[::-1]
+        buffer[offset + 4 : offset + 36] = self.prev_block[::-1]
         # merkle root is an integer in 32 bytes, little-endian
-        result += self.merkle_root[::-1]
+        buffer[offset + 36 : offset + 68] = self.merkle_root[::-1]
         # timestamp is an integer in 4 bytes, little-endian,
-        result += int_to_little_endian(self.timestamp, 4)
+        UINT32.pack_into(buffer, offset + 68, self.timestamp)
         # bits is an integer in 4 bytes, little-endian
-        result += self.bits
+        buffer[offset + 72 : offset + 76] = self.bits
         # nonce is an integer in 4 bytes, little-endian
-        result += self.nonce
+        buffer[offset + 76 : offset + 80] = self.nonce
+        return offset + 80
 
-        return result
+    def serialize(self):
+        """Returns the 80 byte block header"""
+        buffer = bytearray(80)
+        self.serialize_into(buffer, 0)
+        return bytes(buffer)
 
     def hash(self):
         """Binary hash of the legacy serialization"""
@@ -118,13 +133,14 @@ class Block:
         # return whether this integer is less than the target
         return proof < self.target()
 
-    def validate_merkle_root(self):
+    def validate_merkle_root(self, executor=None):
         """Gets the merkle root of the tx_hashes and checks that it's
         the same as the merkle root of this block.
+        Large blocks can pass an executor to hash the levels in parallel.
         """
         # reverse each item in self.tx_hashes
         reversed_tx_hashes = [h[::-1] for h in self.tx_hashes]
         # compute the Merkle Root and reverse
-        checked_merkle_root = merkle_root(reversed_tx_hashes)[::-1]
+        checked_merkle_root = merkle_root(reversed_tx_hashes, executor)[::-1]
         # return whether self.merkle_root is the same
         return self.merkle_root == checked_merkle_root
@@ -0,0 +1,144 @@
+import struct
+
+
+# Fixed-width integers are read with unpack_from and written with pack_into
+# at an offset of a bytes-like buffer, so parsers don't slice a bytes object
+# per field and serializers can fill one preallocated bytearray.
+UINT16 = struct.Struct("<H")
+UINT32 = struct.Struct("<I")
+UINT64 = struct.Struct("<Q")
+# port numbers of network addresses are big endian
+UINT16_BE = struct.Struct(">H")
+
+# bytes first read from seekable streams that can't be parsed in place,
+# doubled until the object fits
+STREAM_CHUNK = 4096
+
+
+def varint_size(i):
+    """Returns how many bytes encode_varint(i) takes"""
+    if i < 0xFD:
+        return 1
+    elif i < 0x10000:
+        return 3
+    elif i < 0x100000000:
+        return 5
+    elif i < 0x10000000000000000:
+        return 9
+    else:
+        raise ValueError("integer too large: {}".format(i))
+
+
+def unpack_varint_from(buffer, offset):
+    """Reads the varint at offset of buffer, returns it and the offset
+    right after it"""
+    i = buffer[offset]
+    if i == 0xFD:
+        # 0xfd means the next two bytes are the number
+        return UINT16.unpack_from(buffer, offset + 1)[0], offset + 3
+    elif i == 0xFE:
+        # 0xfe means the next four bytes are the number
+        return UINT32.unpack_from(buffer, offset + 1)[0], offset + 5
+    elif i == 0xFF:
+        # 0xff means the next eight bytes are the number
+        return UINT64.unpack_from(buffer, offset + 1)[0], offset + 9
+    else:
+        # anything else is just the integer
+        return i, offset + 1
+
+
+def pack_varint_into(buffer, offset, i):
+    """Writes i as a varint at offset of buffer, returns the offset right
+    after it"""
+    if i < 0xFD:
+        buffer[offset] = i
+        return offset + 1
+    elif i < 0x10000:
+        buffer[offset] = 0xFD
+        UINT16.pack_into(buffer, offset + 1, i)
+        return offset + 3
+    elif i < 0x100000000:
+        buffer[offset] = 0xFE
+        UINT32.pack_into(buffer, offset + 1, i)
+        return offset + 5
+    elif i < 0x10000000000000000:
+        buffer[offset] = 0xFF
+        UINT64.pack_into(buffer, offset + 1, i)
+        return offset + 9
+    else:
+        raise ValueError("integer too large: {}".format(i))
+
+
+def pack_bytes_into(buffer, offset, data):
+    """Copies data to offset of buffer, returns the offset right after it"""
+    end = offset + len(data)
+    buffer[offset:end] = data
+    return end
+
+
+def parse_buffer(buffer, offset, parse_from, *args):
+    """Runs parse_from(buffer, offset, *args) and returns its result and
+    end offset. Raises SyntaxError if buffer ends before the object does."""
+    try:
+        result, end = parse_from(buffer, offset, *args)
+    except (IndexError, struct.error):
+        raise SyntaxError("data ended before the object did")
+    if end > len(buffer):
+        raise SyntaxError("data ended before the object did")
+    return result, end
+
+
+def parse_stream(s, parse_from, *args):
+    """Runs parse_from(buffer, offset, *args) over the unread bytes of the
+    stream s and moves s right after what was parsed. BytesIO streams are
+    parsed in place, other seekable streams are read in growing chunks and
+    sought back. Raises SyntaxError if the stream ends before the object."""
+    if hasattr(s, "getbuffer"):
+        offset = s.tell()
+        with s.getbuffer() as buffer:
+            result, offset = parse_buffer(buffer, offset, parse_from, *args)
+        s.seek(offset)
+        return result
+    if s.seekable():
+        start = s.tell()
+        data = b""
+        size = STREAM_CHUNK
+        while True:
+            chunk = s.read(size)
+            data += chunk
+            try:
+                result, end = parse_buffer(data, 0, parse_from, *args)
+            except SyntaxError:
+                if not chunk:
+                    raise
+                end = None
+            # an object that ends with the data might have optional fields
+            # in the next chunk
+            if end is not None and (end < len(data) or not chunk):
+                s.seek(start + end)
+                return result
+            size *= 2
+    # bytes read past the object can't be put back, so only what the
+    # stream has already buffered (peek) or one byte at a time is taken,
+    # until there is enough to parse the object
+    peek = getattr(s, "peek", None)
+    data = b""
+    while True:
+        if peek is not None:
+            ahead = peek(1)
+        else:
+            ahead = s.read(1)
+        if not ahead:
+            raise SyntaxError("stream ended before the object did")
+        attempt = data + ahead
+        try:
+            result, end = parse_buffer(attempt, 0, parse_from, *args)
+        except SyntaxError:
+            # possibly only cut short, read on
+            end = None
+        if peek is not None:
+            # consume what was used
+            s.read(len(ahead) if end is None else end - len(data))
+        if end is not None:
+            return result
+        data = attempt
@@ -1,5 +1,6 @@
-from Crypto.Hash import SHA256
+from concurrent.futures import ProcessPoolExecutor
 from helper import hash160, encode_base58_checksum
+import hashlib
 import hmac
 
 
@@ -179,6 +180,193 @@ Gy = 0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8
 N = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
 
 
+# Jacobian coordinates: (X, Y, Z) of plain ints stands for the affine point
+# (X/Z**2, Y/Z**3), Z == 0 is the point at infinity.
+# Adding points this way needs no inversion, so S256Point converts to them
+# for longer computations and back once at the end.
+INFINITY = (0, 1, 0)
+
+
+def batch_inverse(nums, modulus):
+    '''Returns the inverses of nums modulo the prime modulus using a single
+    exponentiation (Montgomery's trick). None of nums may be 0.'''
+    prefixes = []
+    acc = 1
+    for num in nums:
+        prefixes.append(acc)
+        acc = acc * num % modulus
+    acc_inv = pow(acc, modulus - 2, modulus)
+    result = [0] * len(nums)
+    for i in range(len(nums) - 1, -1, -1):
+        result[i] = prefixes[i] * acc_inv % modulus
+        acc_inv = acc_inv * nums[i] % modulus
+    return result
+
+
+def jacobian_double(p):
+    x, y, z = p
+    if z == 0 or y == 0:
+        return INFINITY
+    yy = y * y % P
+    s = 4 * x * yy % P
+    # a is 0 for secp256k1
+    m = 3 * x * x % P
+    x3 = (m * m - 2 * s) % P
+    y3 = (m * (s - x3) - 8 * yy * yy) % P
+    z3 = 2 * y * z % P
+    return (x3, y3, z3)
+
+
+def jacobian_add(p, q):
+    if p[2] == 0:
+        return q
+    if q[2] == 0:
+        return p
+    x1, y1, z1 = p
+    x2, y2, z2 = q
+    z1z1 = z1 * z1 % P
+    z2z2 = z2 * z2 % P
+    u1 = x1 * z2z2 % P
+    u2 = x2 * z1z1 % P
+    s1 = y1 * z2 * z2z2 % P
+    s2 = y2 * z1 * z1z1 % P
+    if u1 == u2:
+        if s1 == s2:
+            return jacobian_double(p)
+        return INFINITY
+    h = (u2 - u1) % P
+    r = (s2 - s1) % P
+    hh = h * h % P
+    hhh = h * hh % P
+    v = u1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    y3 = (r * (v - x3) - s1 * hhh) % P
+    z3 = h * z1 * z2 % P
+    return (x3, y3, z3)
+
+
+def jacobian_negate(p):
+    return (p[0], (-p[1]) % P, p[2])
+
+
+def jacobian_multiply(p, coefficient):
+    '''Returns coefficient * p'''
+    result = INFINITY
+    for bit in bin(coefficient % N)[2:]:
+        result = jacobian_double(result)
+        if bit == '1':
+            result = jacobian_add(result, p)
+    return result
+
+
+def jacobian_multiply_sum(p, u, q, v):
+    '''Returns u * p + v * q sharing the doublings (Shamir's trick)'''
+    u %= N
+    v %= N
+    both = jacobian_add(p, q)
+    result = INFINITY
+    for i in range(max(u.bit_length(), v.bit_length()) - 1, -1, -1):
+        result = jacobian_double(result)
+        bits = (u >> i & 1, v >> i & 1)
+        if bits == (1, 1):
+            result = jacobian_add(result, both)
+        elif bits == (1, 0):
+            result = jacobian_add(result, p)
+        elif bits == (0, 1):
+            result = jacobian_add(result, q)
+    return result
+
+
+def batch_normalize(points):
+    '''Converts Jacobian points to affine (x, y) int pairs sharing one
+    inversion, None stands for the point at infinity'''
+    finite = [p for p in points if p[2] != 0]
+    z_invs = iter(batch_inverse([p[2] for p in finite], P))
+    result = []
+    for x, y, z in points:
+        if z == 0:
+            result.append(None)
+            continue
+        z_inv = next(z_invs)
+        z_inv2 = z_inv * z_inv % P
+        result.append((x * z_inv2 % P, y * z_inv2 * z_inv % P))
+    return result
+
+
+# window size in bits of strauss_multiply
+STRAUSS_WINDOW = 4
+# from this many terms on multi_scalar_multiply uses the bucket method
+PIPPENGER_THRESHOLD = 64
+
+
+def strauss_multiply(terms):
+    '''Returns the sum of scalar * point over (scalar, point) Jacobian terms.
+    Every point gets a table of its first multiples and all of them share
+    the same doublings.'''
+    mask = (1 << STRAUSS_WINDOW) - 1
+    tables = []
+    bits = 0
+    for scalar, point in terms:
+        row = [INFINITY, point]
+        for _ in range(mask - 1):
+            row.append(jacobian_add(row[-1], point))
+        tables.append((scalar, row))
+        bits = max(bits, scalar.bit_length())
+    result = INFINITY
+    top = (bits - 1) // STRAUSS_WINDOW * STRAUSS_WINDOW
+    for shift in range(top, -1, -STRAUSS_WINDOW):
+        for _ in range(STRAUSS_WINDOW):
+            result = jacobian_double(result)
+        for scalar, row in tables:
+            digit = scalar >> shift & mask
+            if digit:
+                result = jacobian_add(result, row[digit])
+    return result
+
+
+def pippenger_multiply(terms):
+    '''Returns the sum of scalar * point over (scalar, point) Jacobian terms
+    with the bucket method: per window every point is added once to the
+    bucket of its digit, then the buckets are summed with their weights.'''
+    count = len(terms)
+    # window size that minimizes the number of additions
+    window = min(range(1, 17),
+                 key=lambda c: (256 + c - 1) // c * (count + 2 ** (c + 1)))
+    mask = (1 << window) - 1
+    bits = max(scalar.bit_length() for scalar, _ in terms)
+    result = INFINITY
+    top = (bits - 1) // window * window
+    for shift in range(top, -1, -window):
+        for _ in range(window):
+            result = jacobian_double(result)
+        buckets = [INFINITY] * (mask + 1)
+        for scalar, point in terms:
+            digit = scalar >> shift & mask
+            if digit:
+                buckets[digit] = jacobian_add(buckets[digit], point)
+        # running holds the sum of buckets[digit:], adding it once per
+        # digit weights every bucket by its digit
+        running = INFINITY
+        window_sum = INFINITY
+        for digit in range(mask, 0, -1):
+            running = jacobian_add(running, buckets[digit])
+            window_sum = jacobian_add(window_sum, running)
+        result = jacobian_add(result, window_sum)
+    return result
+
+
+def multi_scalar_multiply(terms):
+    '''Returns the sum of scalar * point over (scalar, point) Jacobian terms,
+    using Strauss for few terms and Pippenger for many'''
+    terms = [(scalar % N, point) for scalar, point in terms
+             if point[2] != 0 and scalar % N]
+    if not terms:
+        return INFINITY
+    if len(terms) < PIPPENGER_THRESHOLD:
+        return strauss_multiply(terms)
+    return pippenger_multiply(terms)
+
+
 class S256Point(Point):
 
     def __init__(self, x, y, a=None, b=None):
@@ -192,11 +380,92 @@ class S256Point(Point):
         coef = coefficient % N
         return super().__rmul__(coef)
 
+    def jacobian(self):
+        '''Returns this point in Jacobian coordinates'''
+        if self.x is None:
+            return INFINITY
+        return (self.x.num, self.y.num, 1)
+
+    @classmethod
+    def from_jacobian(cls, p):
+        '''Returns the S256Point of the Jacobian point p'''
+        coordinates = batch_normalize([p])[0]
+        if coordinates is None:
+            return cls(None, None)
+        return cls(*coordinates)
+
+    @classmethod
+    def multi_multiply(cls, terms):
+        '''Returns the sum of scalar * point over (scalar, S256Point) terms,
+        for instance an aggregate of weighted public keys'''
+        return cls.from_jacobian(multi_scalar_multiply(
+            [(scalar, point.jacobian()) for scalar, point in terms]))
+
+    @classmethod
+    def recover(cls, z, sig, recid):
+        '''Returns the public key for which sig is a valid signature of z.
+        recid picks the R point used in signing: bit 0 is the parity of its
+        y and bit 1 means its x is r + N instead of r.
+        Raises ValueError if there is no such key.'''
+        point = cls.recover_many([(z, sig, recid)])[0]
+        if point is None:
+            raise ValueError('cannot recover a key from {}'.format(sig))
+        return point
+
+    @classmethod
+    def recover_many(cls, items):
+        '''Like recover for a list of (z, sig, recid) but shares the
+        inversions between all of them. The result has None for every item
+        that has no key.'''
+        jobs = []
+        for z, sig, recid in items:
+            if not 0 < sig.r < N or not 0 < sig.s < N:
+                jobs.append(None)
+                continue
+            x = sig.r + N if recid & 2 else sig.r
+            if x >= P:
+                jobs.append(None)
+                continue
+            # solve y^2 = x^3 + 7 for R
+            alpha = (pow(x, 3, P) + B) % P
+            beta = pow(alpha, (P + 1) // 4, P)
+            if beta * beta % P != alpha:
+                jobs.append(None)
+                continue
+            if beta % 2 != recid & 1:
+                beta = P - beta
+            jobs.append((z, sig, (x, beta, 1)))
+        r_invs = iter(batch_inverse(
+            [job[1].r for job in jobs if job is not None], N))
+        results = []
+        for job in jobs:
+            if job is None:
+                results.append(INFINITY)
+                continue
+            z, sig, R = job
+            r_inv = next(r_invs)
+            # Q = r^-1 * (s * R - z * G)
+            results.append(jacobian_multiply_sum(
+                G.jacobian(), -z * r_inv, R, sig.s * r_inv))
+        points = []
+        for coordinates in batch_normalize(results):
+            if coordinates is None:
+                points.append(None)
+            else:
+                points.append(cls(*coordinates))
+        return points
+
     def verify(self, z, sig):
+        # r and s outside 1 to N - 1 never verify
+        if not 0 < sig.r < N or not 0 < sig.s < N:
+            return False
         s_inv = pow(sig.s, N-2, N)
         u = z * s_inv % N
         v = sig.r * s_inv % N
         R = u * G + v * self
+        # the point at infinity has no x to compare
+        if R.x is None:
+            return False
         return R.x.num == sig.r
 
     def sec(self, compressed=True):
@@ -249,6 +518,46 @@ class S256Point(Point):
 G = S256Point(Gx, Gy)
 
 
+# k * G is computed by adding one precomputed multiple of G per window of
+# G_WINDOW bits of k, no doublings. The table is built on first use.
+G_WINDOW = 8
+G_TABLE = []
+
+
+def build_g_table():
+    '''Fills G_TABLE so that G_TABLE[i][d] is d * 2**(G_WINDOW * i) * G as a
+    Jacobian point with Z == 1'''
+    rows = []
+    base = G.jacobian()
+    for _ in range((256 + G_WINDOW - 1) // G_WINDOW):
+        row = [base]
+        for _ in range((1 << G_WINDOW) - 2):
+            row.append(jacobian_add(row[-1], base))
+        rows.append(row)
+        base = jacobian_add(row[-1], base)
+    affine = iter(batch_normalize([p for row in rows for p in row]))
+    G_TABLE[:] = [
+        [INFINITY] + [(x, y, 1) for x, y in (next(affine) for _ in row)]
+        for row in rows]
+
+
+def fixed_base_multiply(coefficient):
+    '''Returns coefficient * G in Jacobian coordinates'''
+    if not G_TABLE:
+        build_g_table()
+    coefficient %= N
+    mask = (1 << G_WINDOW) - 1
+    result = INFINITY
+    for row in G_TABLE:
+        if not coefficient:
+            break
+        digit = coefficient & mask
+        if digit:
+            result = jacobian_add(result, row[digit])
+        coefficient >>= G_WINDOW
+    return result
+
+
 class Signature:
 
     def __init__(self, r, s):
@@ -259,41 +568,72 @@ class Signature:
         return 'Signature({:x},{:x})'.format(self.r, self.s)
 
     def der(self):
-        rbin = self.r.to_bytes(32, 'big')
-        # remove all null bytes at the beginning
-        rbin = rbin.lstrip(b'\x00')
-        # if rbin has a high bit, add a \x00
-        if rbin[0] & 0x80:
-            rbin = b'\x00' + rbin
-        result = bytes([2, len(rbin)]) + rbin
-        sbin = self.s.to_bytes(32, 'big')
-        # remove all null bytes at the beginning
-        sbin = sbin.lstrip(b'\x00')
-        # if sbin has a high bit, add a \x00
-        if sbin[0] & 0x80:
-            sbin = b'\x00' + sbin
-        result += bytes([2, len(sbin)]) + sbin
-        return bytes([0x30, len(result)]) + result
+        # big endian with a leading 0 byte if the high bit is set
+        rbin = self.r.to_bytes(self.r.bit_length() // 8 + 1, 'big')
+        sbin = self.s.to_bytes(self.s.bit_length() // 8 + 1, 'big')
+        return b''.join((
+            bytes((0x30, len(rbin) + len(sbin) + 4, 2, len(rbin))),
+            rbin,
+            bytes((2, len(sbin))),
+            sbin,
+        ))
+
+    @classmethod
+    def parse(cls, signature_bin):
+        '''Takes a strict DER signature (BIP66) without the hash_type and
+        returns a Signature object'''
+        view = memoryview(signature_bin)
+        length = len(view)
+        if length < 8 or length > 72:
+            raise SyntaxError('bad signature length: {}'.format(length))
+        if view[0] != 0x30 or view[1] != length - 2:
+            raise SyntaxError('bad signature')
+        r_length = view[3]
+        if 5 + r_length >= length:
+            raise SyntaxError('bad signature r length')
+        s_length = view[5 + r_length]
+        if r_length + s_length + 6 != length:
+            raise SyntaxError('bad signature s length')
+        nums = []
+        for start, num_length in ((4, r_length), (6 + r_length, s_length)):
+            if view[start - 2] != 0x02:
+                raise SyntaxError('bad signature integer marker')
+            if num_length == 0:
+                raise SyntaxError('empty signature integer')
+            if view[start] & 0x80:
+                raise SyntaxError('negative signature integer')
+            # only a leading 0 that keeps the next byte positive is allowed
+            if num_length > 1 and view[start] == 0 \
+                    and not view[start + 1] & 0x80:
+                raise SyntaxError('signature integer not minimally encoded')
+            nums.append(int.from_bytes(view[start:start + num_length], 'big'))
+        return cls(*nums)
+
+    def is_low_s(self):
+        '''Returns whether s is in the lower half of the order, the form
+        PrivateKey.sign produces'''
+        return self.s <= N // 2
 
 
 class PrivateKey:
 
-    def __init__(self, secret):
+    def __init__(self, secret, point=None):
         self.secret = secret
-        self.point = secret * G
+        if point is not None:
+            # the caller already computed secret * G
+            self.point = point
+            return
+        self.point = S256Point.from_jacobian(fixed_base_multiply(secret))
 
     def hex(self):
         return '{:x}'.format(self.secret).zfill(64)
 
     def sign(self, z):
-        k = self.deterministic_k(z)
-        r = (k * G).x.num
-        k_inv = pow(k, N-2, N)
-        s = (z + r * self.secret) * k_inv % N
+        return self.sign_many([z])[0]
 
-        if s > N/2:
-            s = N - s
-        return Signature(r, s)
+    def sign_many(self, zs):
+        '''Signs every z of zs, returns the Signatures in the same order'''
+        return sign_batch([(self, z) for z in zs])
 
     # WIF Format is a serialization of the private key that's meant to be human readable private key.
     def wif(self, compressed=True, testnet=False):
@@ -315,24 +655,86 @@ class PrivateKey:
         # 6 Take result combination and the first 4 bytes of hash256 and encoded it in Base58
         return encode_base58_checksum(prefix + secret_bytes + suffix)
 
-    # source https://tools.ietf.org/html/rfc6979#appendix-A.1.2
     # RFC 6979 specification for deterministic k value generation
     def deterministic_k(self, z):
-        k = b'\x00' * 32
-        v = b'\x01' * 32
-        if z > N:
-            z -= N
-        z_bytes = z.to_bytes(32, 'big')
-        secret_bytes = self.secret.to_bytes(32, 'big')
-        s256 = SHA256.new()
-        k = hmac.new(k, v + b'\x00' + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
-        k = hmac.new(k, v + b'\x01' + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
-        while True:
-            v = hmac.new(k, v, s256).digest()
-            candidate = int.from_bytes(v, 'big')
-            if candidate >= 1 and candidate < N:
-                return candidate
-            k = hmac.new(k, v + b'\x00', s256).digest()
-            v = hmac.new(k, v, s256).digest()
+        return deterministic_k(self.secret, z)
+
+
+# HMAC-SHA256 keyed with the 32 zero bytes RFC 6979 starts from, copied for
+# each signature instead of hashing the key again
+ZERO_KEY_HMAC = hmac.new(b'\x00' * 32, digestmod=hashlib.sha256)
+
+
+# source https://tools.ietf.org/html/rfc6979#appendix-A.1.2
+def deterministic_k(secret, z):
+    v = b'\x01' * 32
+    if z > N:
+        z -= N
+    data = secret.to_bytes(32, 'big') + z.to_bytes(32, 'big')
+    mac = ZERO_KEY_HMAC.copy()
+    mac.update(v + b'\x00' + data)
+    k = mac.digest()
+    v = hmac.digest(k, v, 'sha256')
+    k = hmac.digest(k, v + b'\x01' + data, 'sha256')
+    v = hmac.digest(k, v, 'sha256')
+    while True:
+        v = hmac.digest(k, v, 'sha256')
+        candidate = int.from_bytes(v, 'big')
+        if candidate >= 1 and candidate < N:
+            return candidate
+        k = hmac.digest(k, v + b'\x00', 'sha256')
+        v = hmac.digest(k, v, 'sha256')
+
+
+def sign_secrets(items):
+    '''Signs a list of (secret, z) and returns (r, s) pairs. All the R
+    points are normalized and all the k are inverted together.'''
+    ks = [deterministic_k(secret, z) for secret, z in items]
+    rs = batch_normalize([fixed_base_multiply(k) for k in ks])
+    k_invs = batch_inverse(ks, N)
+    result = []
+    for (secret, z), (r, _), k_inv in zip(items, rs, k_invs):
+        s = (z + r * secret) * k_inv % N
+        if s > N // 2:
+            s = N - s
+        result.append((r, s))
+    return result
+
+
+def sign_batch(items, processes=None):
+    '''Signs a list of (private_key, z) and returns the Signatures in the
+    same order. With processes the items are split between that many
+    worker processes.'''
+    jobs = [(private_key.secret, z) for private_key, z in items]
+    if processes and processes > 1 and len(jobs) > 1:
+        size = -(-len(jobs) // processes)
+        chunks = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+        with ProcessPoolExecutor(processes) as executor:
+            pairs = [pair for chunk in executor.map(sign_secrets, chunks)
+                     for pair in chunk]
+    else:
+        pairs = sign_secrets(jobs)
+    return [Signature(r, s) for r, s in pairs]
+
+
+def sequential_keys(start, count, compressed=True, testnet=False,
+                    batch_size=1024):
+    '''Yields (secret, point, address) for the secrets start up to
+    start + count - 1. Each point is the previous one plus G, and every
+    batch_size points are converted to affine together.'''
+    if start < 1 or start + count > N:
+        raise ValueError('secrets must be between 1 and N - 1')
+    g = G.jacobian()
+    current = fixed_base_multiply(start)
+    secret = start
+    while count > 0:
+        size = min(batch_size, count)
+        batch = []
+        for _ in range(size):
+            batch.append(current)
+            current = jacobian_add(current, g)
+        for x, y in batch_normalize(batch):
+            point = S256Point(x, y)
+            yield secret, point, point.address(compressed, testnet)
+            secret += 1
+        count -= size
@@ -0,0 +1,204 @@
+from functools import lru_cache
+import hmac
+
+from ecc import (
+    batch_normalize,
+    fixed_base_multiply,
+    jacobian_add,
+    N,
+    PrivateKey,
+    S256Point,
+)
+from helper import (
+    decode_base58_checksum,
+    encode_base58_checksum,
+    hash160,
+)
+
+
+# BIP32 hierarchical deterministic keys
+HARDENED = 0x80000000
+
+# version bytes of the serialized keys, by (testnet, private)
+VERSIONS = {
+    (False, True): bytes.fromhex('0488ade4'),
+    (False, False): bytes.fromhex('0488b21e'),
+    (True, True): bytes.fromhex('04358394'),
+    (True, False): bytes.fromhex('043587cf'),
+}
+VERSION_KINDS = {version: kind for kind, version in VERSIONS.items()}
+
+# number of derived keys kept so that derivations sharing a path prefix
+# (m/44'/0'/0'/0/i for every i) only compute the common parents once
+NODE_CACHE_SIZE = 4096
+
+
+def parse_path(path):
+    '''Turns a path like "m/44'/0'/0'/0/5" into a tuple of child indexes,
+    hardened steps are marked with ' or h'''
+    parts = path.split('/')
+    if parts[0] not in ('m', 'M'):
+        raise ValueError('path must start with m: {}'.format(path))
+    indexes = []
+    for part in parts[1:]:
+        if part[-1:] in ("'", 'h', 'H'):
+            index = int(part[:-1]) + HARDENED
+        else:
+            index = int(part)
+        if not 0 <= index < 2**32 or (
+                part[-1:] in ("'", 'h', 'H') and index < HARDENED):
+            raise ValueError('bad path index: {}'.format(part))
+        indexes.append(index)
+    return tuple(indexes)
+
+
+class ExtendedKey:
+
+    def __init__(self, key, chain_code, depth=0,
+                 parent_fingerprint=b'\x00\x00\x00\x00', child_number=0,
+                 testnet=False):
+        # key is a PrivateKey for private extended keys, S256Point otherwise
+        self.key = key
+        self.chain_code = chain_code
+        self.depth = depth
+        self.parent_fingerprint = parent_fingerprint
+        self.child_number = child_number
+        self.testnet = testnet
+        self.is_private = isinstance(key, PrivateKey)
+        if self.is_private:
+            self.point = key.point
+            self.key_data = b'\x00' + key.secret.to_bytes(32, 'big')
+        else:
+            self.point = key
+            self.key_data = key.sec()
+
+    def __repr__(self):
+        return self.serialize()
+
+    def __eq__(self, other):
+        if not isinstance(other, ExtendedKey):
+            return NotImplemented
+        return self.serialize_bytes() == other.serialize_bytes()
+
+    def __hash__(self):
+        return hash((self.key_data, self.chain_code, self.depth,
+                     self.child_number, self.testnet))
+
+    @classmethod
+    def from_seed(cls, seed, testnet=False):
+        '''Returns the master private key of a seed'''
+        digest = hmac.digest(b'Bitcoin seed', seed, 'sha512')
+        secret = int.from_bytes(digest[:32], 'big')
+        if not 0 < secret < N:
+            raise ValueError('seed gives an invalid master key')
+        return cls(PrivateKey(secret), digest[32:], testnet=testnet)
+
+    def fingerprint(self):
+        return hash160(self.point.sec())[:4]
+
+    def address(self, compressed=True):
+        return self.point.address(compressed, self.testnet)
+
+    def neuter(self):
+        '''Returns the public extended key of this key'''
+        return self.__class__(
+            self.point, self.chain_code, self.depth, self.parent_fingerprint,
+            self.child_number, self.testnet)
+
+    def tweak(self, index):
+        '''Returns the (IL, IR) pair of BIP32 child key derivation'''
+        if index >= HARDENED:
+            if not self.is_private:
+                raise ValueError('cannot derive a hardened child of a public key')
+            data = self.key_data
+        else:
+            data = self.point.sec()
+        digest = hmac.digest(
+            self.chain_code, data + index.to_bytes(4, 'big'), 'sha512')
+        il = int.from_bytes(digest[:32], 'big')
+        if il >= N:
+            raise ValueError('index {} gives an invalid child'.format(index))
+        return il, digest[32:]
+
+    @lru_cache(maxsize=NODE_CACHE_SIZE)
+    def child(self, index):
+        '''Returns the child key at index, use index + HARDENED for hardened
+        derivation'''
+        return self.derive_range(index, 1)[0]
+
+    def derive(self, path):
+        '''Returns the key at path, relative to this key.
+        path is a string like "m/44'/0'/0'/0/5" or a sequence of indexes.'''
+        if isinstance(path, str):
+            path = parse_path(path)
+        key = self
+        for index in path:
+            key = key.child(index)
+        return key
+
+    def derive_range(self, start, count):
+        '''Returns the count children from index start on. All of their
+        public keys are converted to affine together.'''
+        if start < 0 or count < 0 or start + count > 2**32:
+            raise ValueError('bad child range {} {}'.format(start, count))
+        fingerprint = self.fingerprint()
+        jobs = []
+        points = []
+        for index in range(start, start + count):
+            il, chain_code = self.tweak(index)
+            if self.is_private:
+                secret = (il + self.key.secret) % N
+                points.append(fixed_base_multiply(secret))
+            else:
+                secret = None
+                points.append(jacobian_add(
+                    fixed_base_multiply(il), self.point.jacobian()))
+            jobs.append((index, secret, chain_code))
+        children = []
+        for (index, secret, chain_code), coordinates in zip(
+                jobs, batch_normalize(points)):
+            if coordinates is None:
+                raise ValueError('index {} gives an invalid child'.format(index))
+            point = S256Point(*coordinates)
+            if secret is not None:
+                key = PrivateKey(secret, point)
+            else:
+                key = point
+            children.append(self.__class__(
+                key, chain_code, self.depth + 1, fingerprint, index,
+                self.testnet))
+        return children
+
+    def serialize_bytes(self):
+        return b''.join((
+            VERSIONS[(self.testnet, self.is_private)],
+            bytes((self.depth,)),
+            self.parent_fingerprint,
+            self.child_number.to_bytes(4, 'big'),
+            self.chain_code,
+            self.key_data,
+        ))
+
+    def serialize(self):
+        '''Returns the xprv/xpub (tprv/tpub on testnet) string'''
+        return encode_base58_checksum(self.serialize_bytes())
+
+    @classmethod
+    def parse(cls, s):
+        '''Takes an xprv/xpub/tprv/tpub string and returns an ExtendedKey'''
+        raw = decode_base58_checksum(s)
+        if len(raw) != 78 or raw[:4] not in VERSION_KINDS:
+            raise ValueError('not an extended key: {}'.format(s))
+        testnet, private = VERSION_KINDS[raw[:4]]
+        key_data = raw[45:]
+        if private:
+            secret = int.from_bytes(key_data[1:], 'big')
+            if key_data[0] != 0 or not 0 < secret < N:
+                raise ValueError('bad private key in {}'.format(s))
+            key = PrivateKey(secret)
+        else:
+            if key_data[0] not in (2, 3):
+                raise ValueError('bad public key in {}'.format(s))
+            key = S256Point.parse(key_data)
+        return cls(key, raw[13:45], raw[4], raw[5:9],
+                   int.from_bytes(raw[9:13], 'big'), testnet)
@@ -0,0 +1,145 @@
+from io import BytesIO
+
+from bitcoin_protocol.block import Block, GENESIS_BLOCK
+from bitcoin_protocol.helper import bits_to_target, calculate_new_bits
+
+
+def block_work(bits):
+    """Returns the expected number of hashes to find a block with bits,
+    the amount it adds to the chainwork"""
+    return 2**256 // (bits_to_target(bits) + 1)
+
+
+class Reorg:
+    """A change of the best chain that wasn't only an extension of it:
+    the blocks above fork_height were replaced"""
+
+    def __init__(self, fork_height, disconnected, connected):
+        self.fork_height = fork_height
+        # Blocks that left the best chain, from the lowest
+        self.disconnected = disconnected
+        # Blocks that joined the best chain, from the lowest
+        self.connected = connected
+
+    def __repr__(self):
+        return "reorg at height {}: -{} +{}".format(
+            self.fork_height, len(self.disconnected), len(self.connected)
+        )
+
+
+class HeaderChain:
+    """Follows every branch of block headers from the genesis block and
+    keeps the one with the most chainwork as the best chain.
+    The best chain lives in a HeaderStore, other branches in memory."""
+
+    def __init__(self, store, genesis=GENESIS_BLOCK, check_bits=True):
+        self.store = store
+        # the mainnet difficulty adjustment rules, testnet allows
+        # minimum difficulty blocks which break them
+        self.check_bits = check_bits
+        if len(store) == 0:
+            store.append(Block.parse(BytesIO(genesis)))
+        # cumulative chainwork of the best chain by height
+        self.work = []
+        total = 0
+        work_of_bits = {}
+        for height in range(len(store)):
+            bits = store.raw(height)[72:76]
+            if bits not in work_of_bits:
+                work_of_bits[bits] = block_work(bits)
+            total += work_of_bits[bits]
+            self.work.append(total)
+        # block hash -> (Block, height, chainwork) of the other branches
+        self.branches = {}
+        self.tip_hash = store.block_hash(store.height())
+
+    def __contains__(self, block_hash):
+        """Whether the block hash is on the best chain"""
+        return block_hash in self.store
+
+    def __len__(self):
+        return len(self.store)
+
+    def height(self):
+        """Returns the height of the best tip"""
+        return self.store.height()
+
+    def tip(self):
+        """Returns the hash of the best tip"""
+        return self.tip_hash
+
+    def chainwork(self):
+        """Returns the cumulative chainwork of the best chain"""
+        return self.work[-1]
+
+    def ancestor(self, block_hash, height):
+        """Returns the Block at height on the branch of block_hash"""
+        while block_hash in self.branches:
+            block, block_height, _ = self.branches[block_hash]
+            if block_height == height:
+                return block
+            block_hash = block.prev_block
+        # the rest of the branch is on the best chain
+        return self.store.header(height)
+
+    def expected_bits(self, parent, height):
+        """Returns the bits the block at height on top of parent must have"""
+        if height % 2016 != 0:
+            return parent.bits
+        first = self.ancestor(parent.hash(), height - 2016)
+        return calculate_new_bits(parent.bits, parent.timestamp - first.timestamp)
+
+    def add(self, block):
+        """Adds a header whose parent is known and updates the best chain.
+        Returns a Reorg if blocks left the best chain, None otherwise."""
+        block_hash = block.hash()
+        if block_hash in self.store or block_hash in self.branches:
+            return None
+        if not block.check_pow():
+            raise RuntimeError("bad PoW at block {}".format(block_hash.hex()))
+        if block.prev_block in self.branches:
+            parent, parent_height, parent_work = self.branches[block.prev_block]
+        else:
+            parent_height = self.store.height_of(block.prev_block)
+            if parent_height is None:
+                raise RuntimeError("unknown parent of {}".format(block_hash.hex()))
+            parent = self.store.header(parent_height)
+            parent_work = self.work[parent_height]
+        height = parent_height + 1
+        if self.check_bits and block.bits != self.expected_bits(parent, height):
+            raise RuntimeError("bad bits at block {}".format(height))
+        work = parent_work + block_work(block.bits)
+        if block.prev_block == self.tip_hash:
+            # the usual case, the best chain gets longer
+            self.store.append(block)
+            self.work.append(work)
+            self.tip_hash = block_hash
+            return None
+        if work <= self.work[-1]:
+            # first seen wins ties
+            self.branches[block_hash] = (block, height, work)
+            return None
+        # the branch of block has more work, walk it down to the best chain
+        connected = [(block, work)]
+        fork_hash = block.prev_block
+        while fork_hash in self.branches:
+            branch_block, _, branch_work = self.branches.pop(fork_hash)
+            connected.append((branch_block, branch_work))
+            fork_hash = branch_block.prev_block
+        connected.reverse()
+        fork_height = self.store.height_of(fork_hash)
+        disconnected = []
+        for h in range(fork_height + 1, len(self.store)):
+            old_block = self.store.header(h)
+            disconnected.append(old_block)
+            self.branches[old_block.hash()] = (old_block, h, self.work[h])
+        self.store.truncate(fork_height)
+        del self.work[fork_height + 1 :]
+        self.store.extend([connected_block for connected_block, _ in connected])
+        self.work.extend(connected_work for _, connected_work in connected)
+        self.tip_hash = block_hash
+        return Reorg(
+            fork_height,
+            disconnected,
+            [connected_block for connected_block, _ in connected],
+        )
@@ -0,0 +1,132 @@
+import mmap
+import os
+
+from bitcoin_protocol.block import Block
+from bitcoin_protocol.helper import hash256
+
+
+HEADER_SIZE = 80
+# the file grows by this many headers at a time, so appending doesn't
+# remap it for every header
+GROW_HEADERS = 10000
+
+
+class HeaderStore:
+    """Raw 80 byte block headers of one chain in a flat memory-mapped file,
+    the header at height h starts at byte 80 * h. A dict maps block hashes
+    to heights, Block objects are only made when asked for."""
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        self.file = open(path, "r+b")
+        self.map = None
+        self.capacity = os.path.getsize(path) // HEADER_SIZE
+        if self.capacity > 0:
+            self.map = mmap.mmap(self.file.fileno(), self.capacity * HEADER_SIZE)
+        # the file is grown ahead of the headers, what follows the last
+        # header is zeros which no real header is
+        self.count = self.capacity
+        empty = bytes(HEADER_SIZE)
+        while self.count > 0 and self.raw(self.count - 1) == empty:
+            self.count -= 1
+        # block hash -> height
+        self.index = {}
+        for height in range(self.count):
+            self.index[hash256(self.raw(height))[::-1]] = height
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, block_hash):
+        return block_hash in self.index
+
+    def height(self):
+        """Returns the height of the last header, -1 for an empty store"""
+        return self.count - 1
+
+    def height_of(self, block_hash):
+        """Returns the height of the block hash, None if it isn't stored"""
+        return self.index.get(block_hash)
+
+    def raw(self, height):
+        """Returns the 80 byte header at height"""
+        if not 0 <= height < self.count:
+            raise IndexError("no header at height {}".format(height))
+        offset = height * HEADER_SIZE
+        return self.map[offset : offset + HEADER_SIZE]
+
+    def header(self, height):
+        """Returns the Block of the header at height"""
+        if not 0 <= height < self.count:
+            raise IndexError("no header at height {}".format(height))
+        return Block.parse_from(self.map, height * HEADER_SIZE)[0]
+
+    def block_hash(self, height):
+        """Returns the hash of the header at height"""
+        return hash256(self.raw(height))[::-1]
+
+    def grow(self, count):
+        """Makes room for at least count headers"""
+        if count <= self.capacity:
+            return
+        capacity = max(count, self.capacity + GROW_HEADERS)
+        if self.map is not None:
+            self.map.close()
+        self.file.truncate(capacity * HEADER_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), capacity * HEADER_SIZE)
+        self.capacity = capacity
+
+    def append(self, block):
+        """Adds the header of a Block on top of the last one"""
+        self.extend([block])
+
+    def extend(self, blocks):
+        """Adds the headers of Blocks in order on top of the last one.
+        Each must point to the previous one."""
+        if self.count > 0:
+            tip = self.block_hash(self.count - 1)
+        else:
+            tip = None
+        raws = []
+        hashes = []
+        for block in blocks:
+            if tip is not None and block.prev_block != tip:
+                raise RuntimeError(
+                    "discontinuous block at {}".format(self.count + len(raws))
+                )
+            raw = block.serialize()
+            tip = hash256(raw)[::-1]
+            raws.append(raw)
+            hashes.append(tip)
+        self.grow(self.count + len(raws))
+        offset = self.count * HEADER_SIZE
+        self.map[offset : offset + len(raws) * HEADER_SIZE] = b"".join(raws)
+        for block_hash in hashes:
+            self.index[block_hash] = self.count
+            self.count += 1
+
+    def truncate(self, height):
+        """Drops the headers above height, e.g. when the chain reorgs"""
+        height = max(height, -1)
+        for h in range(height + 1, self.count):
+            del self.index[self.block_hash(h)]
+        if self.count > height + 1:
+            offset = (height + 1) * HEADER_SIZE
+            self.map[offset : self.count * HEADER_SIZE] = bytes(
+                (self.count - height - 1) * HEADER_SIZE
+            )
+            self.count = height + 1
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        """Writes the headers out and shrinks the file to them"""
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        self.file.truncate(self.count * HEADER_SIZE)
+        self.file.close()
@@ -4,6 +4,26 @@ SIGHASH_ALL = 1
 SIGHASH_NONE = 2
 SIGHASH_SINGLE = 3
 BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+BASE58_VALUES = {c: i for i, c in enumerate(BASE58_ALPHABET)}
+BASE58_PAIRS = [a + b for a in BASE58_ALPHABET for b in BASE58_ALPHABET]
+BASE58_POWERS = [58 ** i for i in range(11)]
+BECH32_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+BECH32_VALUES = {c: i for i, c in enumerate(BECH32_CHARSET)}
+# xor of the BIP173 generators selected by each 5 bit value
+BECH32_TABLE = [
+    (top & 1 and 0x3B6A57B2)
+    ^ (top & 2 and 0x26508E6D)
+    ^ (top & 4 and 0x1EA119FA)
+    ^ (top & 8 and 0x3D4233DD)
+    ^ (top & 16 and 0x2A1462B3)
+    for top in range(32)
+]
+BECH32_CONST = 1
+BECH32M_CONST = 0x2BC830A3
+# merkle levels of at least this many pairs are split between the workers
+# of an executor, in chunks of MERKLE_CHUNK_PAIRS pairs
+MERKLE_PARALLEL_PAIRS = 8192
+MERKLE_CHUNK_PAIRS = 2048
 TWO_WEEKS = 60 * 60 * 24 * 14
 MAX_TARGET = 0xFFFF * 256 ** (0x1D - 3)
 
@@ -19,39 +39,60 @@ def hash256(s):
 
 
 def encode_base58(s):
-    # determine how many 0 bytes (b'\x00') s starts with
-    count = 0
-    for c in s:
-        if c == 0:
-            count += 1
-        else:
-            break
-    # convert to big endian integer
+    # every leading 0 byte becomes a leading 1
+    count = len(s) - len(s.lstrip(b"\x00"))
     num = int.from_bytes(s, "big")
-    prefix = "1" * count
-    result = ""
+    # take two digits per division, read from BASE58_PAIRS
+    pairs = []
     while num > 0:
-        num, mod = divmod(num, 58)
-        result = BASE58_ALPHABET[mod] + result
-    return prefix + result
+        num, pair = divmod(num, 58 * 58)
+        pairs.append(BASE58_PAIRS[pair])
+    pairs.reverse()
+    return "1" * count + "".join(pairs).lstrip("1")
 
 
 def encode_base58_checksum(s):
     return encode_base58(s + hash256(s)[:4])
 
 
-def decode_base58(s):
+def encode_base58_checksum_many(payloads):
+    """Base58Check encodes every byte sequence of payloads"""
+    return [encode_base58(s + hash256(s)[:4]) for s in payloads]
+
+
+def base58_to_bytes(s):
+    """Decodes a Base58 string of any length, without checking a checksum"""
+    count = len(s) - len(s.lstrip("1"))
     num = 0
-    for c in s:
-        num *= 58
-        num += BASE58_ALPHABET.index(c)
-    combined = num.to_bytes(25, byteorder="big")
-    checksum = combined[-4:]
-    if hash256(combined[:-4])[:4] != checksum:
-        raise ValueError(
-            "bad address: {} {}".format(checksum, hash256(combined[:-4])[:4])
-        )
-    return combined[1:-4]
+    try:
+        for i in range(0, len(s), 10):
+            chunk = 0
+            for c in s[i : i + 10]:
+                chunk = chunk * 58 + BASE58_VALUES[c]
+            num = num * BASE58_POWERS[len(s[i : i + 10])] + chunk
+    except KeyError as e:
+        raise ValueError("bad base58 character: {}".format(e.args[0]))
+    return b"\x00" * count + num.to_bytes((num.bit_length() + 7) // 8, "big")
+
+
+def decode_base58_checksum(s):
+    """Decodes a Base58Check string of any length and returns the payload
+    without the checksum"""
+    combined = base58_to_bytes(s)
+    if len(combined) < 4 or hash256(combined[:-4])[:4] != combined[-4:]:
+        raise ValueError("bad checksum: {}".format(s))
+    return combined[:-4]
+
+
+def decode_base58(s):
+    """Decodes a Base58Check address and returns the payload without the
+    version byte"""
+    return decode_base58_checksum(s)[1:]
+
+
+def decode_base58_many(strings):
+    """decode_base58 for every string of strings"""
+    return [decode_base58_checksum(s)[1:] for s in strings]
 
 
 def little_endian_to_int(b):
@@ -117,6 +158,96 @@ def h160_to_p2sh_address(h160, testnet=False):
     return encode_base58_checksum(prefix + h160)
 
 
+def bech32_polymod(values):
+    """BIP173 checksum of a list of 5 bit values"""
+    chk = 1
+    for value in values:
+        chk = (chk & 0x1FFFFFF) << 5 ^ value ^ BECH32_TABLE[chk >> 25]
+    return chk
+
+
+def bech32_hrp_expand(hrp):
+    """Expands the human readable part for the checksum"""
+    return [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+
+
+def convert_bits(data, from_bits, to_bits, pad=True):
+    """Regroups the bits of data from from_bits to to_bits per value.
+    Returns None if the data can't be regrouped exactly."""
+    acc = 0
+    bits = 0
+    result = []
+    max_value = (1 << to_bits) - 1
+    for value in data:
+        if value >> from_bits:
+            return None
+        acc = acc << from_bits | value
+        bits += from_bits
+        while bits >= to_bits:
+            bits -= to_bits
+            result.append(acc >> bits & max_value)
+    if pad:
+        if bits:
+            result.append(acc << (to_bits - bits) & max_value)
+    elif bits >= from_bits or acc << (to_bits - bits) & max_value:
+        return None
+    return result
+
+
+def encode_bech32_address(version, program, testnet=False):
+    """Takes a witness version and program and returns the segwit address,
+    Bech32 for version 0 and Bech32m for later versions"""
+    hrp = "tb" if testnet else "bc"
+    data = [version] + convert_bits(program, 8, 5)
+    const = BECH32_CONST if version == 0 else BECH32M_CONST
+    polymod = bech32_polymod(bech32_hrp_expand(hrp) + data + [0] * 6) ^ const
+    checksum = [polymod >> 5 * (5 - i) & 31 for i in range(6)]
+    return hrp + "1" + "".join(BECH32_CHARSET[d] for d in data + checksum)
+
+
+def encode_bech32_address_many(items, testnet=False):
+    """encode_bech32_address for every (version, program) of items"""
+    return [
+        encode_bech32_address(version, program, testnet) for version, program in items
+    ]
+
+
+def decode_bech32_address(address, testnet=False):
+    """Takes a segwit address and returns its (version, program),
+    raises ValueError if it isn't valid for the network"""
+    hrp = "tb" if testnet else "bc"
+    if address.lower() != address and address.upper() != address:
+        raise ValueError("mixed case address: {}".format(address))
+    address = address.lower()
+    if not address.startswith(hrp + "1") or len(address) > 90:
+        raise ValueError("not a {} address: {}".format(hrp, address))
+    try:
+        data = [BECH32_VALUES[c] for c in address[len(hrp) + 1 :]]
+    except KeyError as e:
+        raise ValueError("bad bech32 character: {}".format(e.args[0]))
+    if len(data) < 7:
+        raise ValueError("address too short: {}".format(address))
+    version = data[0]
+    const = BECH32_CONST if version == 0 else BECH32M_CONST
+    if bech32_polymod(bech32_hrp_expand(hrp) + data) != const:
+        raise ValueError("bad checksum: {}".format(address))
+    program = convert_bits(data[1:-6], 5, 8, False)
+    if (
+        program is None
+        or version > 16
+        or not 2 <= len(program) <= 40
+        or version == 0
+        and len(program) not in (20, 32)
+    ):
+        raise ValueError("bad witness program: {}".format(address))
+    return version, bytes(program)
+
+
+def decode_bech32_address_many(addresses, testnet=False):
+    """decode_bech32_address for every address of addresses"""
+    return [decode_bech32_address(address, testnet) for address in addresses]
+
+
 def bits_to_target(bits):
     """Turns bits into a target (large 256-bit integer)"""
     # last byte is exponent
@@ -173,43 +304,69 @@ def bytes_to_bit_field(some_bytes):
     return flag_bits
 
 
+def bit_field_to_bytes(bit_field):
+    """Packs a list of bits into bytes, least significant bit first,
+    padding the last byte with zeros"""
+    result = bytearray((len(bit_field) + 7) // 8)
+    for i, bit in enumerate(bit_field):
+        if bit:
+            result[i // 8] |= 1 << (i % 8)
+    return bytes(result)
+
+
 def merkle_parent(hash1, hash2):
     """Takes the binary hashes and calculates the hash256"""
     # return the hash256 of hash1 + hash2
     return hash256(hash1 + hash2)
 
 
+def merkle_parent_hashes(level):
+    """Takes the concatenated 32 byte hashes of a merkle level with an even
+    count and returns the concatenated hashes of its parent level"""
+    view = memoryview(level)
+    sha256 = hashlib.sha256
+    # each pair is hashed straight from its 64 byte slice of the level
+    return b"".join(
+        [
+            sha256(sha256(view[i : i + 64]).digest()).digest()
+            for i in range(0, len(view), 64)
+        ]
+    )
+
+
+def merkle_parent_level_bytes(level, executor=None):
+    """Takes the concatenated 32 byte hashes of a merkle level and returns
+    the concatenated hashes of its parent level. level isn't modified.
+    With an executor from concurrent.futures, levels of at least
+    MERKLE_PARALLEL_PAIRS pairs are split in chunks hashed by its workers."""
+    # if the level has an odd number of hashes, hash the last one with itself
+    if len(level) % 64 == 32:
+        level = bytes(level) + bytes(level[-32:])
+    if executor is None or len(level) < MERKLE_PARALLEL_PAIRS * 64:
+        return merkle_parent_hashes(level)
+    size = MERKLE_CHUNK_PAIRS * 64
+    chunks = [bytes(level[i : i + size]) for i in range(0, len(level), size)]
+    return b"".join(executor.map(merkle_parent_hashes, chunks))
+
+
 def merkle_parent_level(hashes):
     """Takes a list of binary hashes and returns a list that's half
     the length"""
     # if the list has exactly 1 element raise an error
     if len(hashes) == 1:
         raise ValueError("list of hashes must be greater than 1 {}".format(hashes))
-
-    # if the list has an odd number of elements, duplicate the last one
-    # and put it at the end so it has an even number of elements
-    if len(hashes) % 2 == 1:
-        hashes.append(hashes[-1])
-    # initialize next level
-    parent_level = []
-    # loop over every pair (use: for i in range(0, len(hashes), 2))
-    for i in range(0, len(hashes), 2):
-        # get the merkle parent of the hashes at index i and i+1
-        parent_hash = merkle_parent(hashes[i], hashes[i + 1])
-        # append parent to parent level
-        parent_level.append(parent_hash)
-    # return parent level
-    return parent_level
-
-
-def merkle_root(hashes):
-    """Takes a list of binary hashes and returns the merkle root
-    """
-    # current level starts as hashes
-    current_hashes = hashes
-    # loop until there's exactly 1 element
-    while len(current_hashes) > 1:
-        # current level becomes the merkle parent level
-        current_hashes = merkle_parent_level(current_hashes)
-    # return the 1st item of the current level
-    return current_hashes[0]
+    parent_level = merkle_parent_level_bytes(b"".join(hashes))
+    return [parent_level[i : i + 32] for i in range(0, len(parent_level), 32)]
+
+
+def merkle_root(hashes, executor=None):
+    """Takes a list of binary hashes and returns the merkle root.
+    executor is passed to merkle_parent_level_bytes for every level."""
+    if not hashes:
+        raise ValueError("list of hashes must not be empty")
+    # the current level is kept as one contiguous byte string
+    level = b"".join(hashes)
+    # loop until there's exactly 1 hash
+    while len(level) > 32:
+        level = merkle_parent_level_bytes(level, executor)
+    return level
@@ -1,21 +1,32 @@
-import math as m
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
+from bitcoin_protocol.block import Block
+from bitcoin_protocol.codec import (
+    pack_bytes_into,
+    pack_varint_into,
+    parse_stream,
+    UINT32,
+    unpack_varint_from,
+    varint_size,
+)
 from bitcoin_protocol.helper import (
-    bytes_to_bit_field,
-    little_endian_to_int,
+    bit_field_to_bytes,
     merkle_parent,
-    read_varint,
+    merkle_parent_level_bytes,
 )
 
 
 class MerkleTree:
     def __init__(self, total):
         self.total = total
-        self.max_depth = m.ceil(m.log(self.total, 2))
+        # ceil(log2(total)) without the float rounding of math.log,
+        # which gets 2**29 wrong
+        self.max_depth = (self.total - 1).bit_length()
         self.nodes = []
 
         for depths in range(self.max_depth + 1):
-            depth_items = m.ceil(self.total / 2 ** (self.max_depth - depths))
+            depth_items = -(-self.total // 2 ** (self.max_depth - depths))
             level_hashes = [None] * depth_items
             self.nodes.append(level_hashes)
         self.current_depth = 0
@@ -37,6 +48,36 @@ class MerkleTree:
             result.append(", ".join(items))
         return "\n".join(result)
 
+    @classmethod
+    def from_hashes(cls, hashes, executor=None):
+        """Builds the complete tree of a list of binary hashes and keeps
+        every level, executor is passed to merkle_parent_level_bytes"""
+        tree = cls(len(hashes))
+        level = b"".join(hashes)
+        for depth in range(tree.max_depth, -1, -1):
+            tree.nodes[depth] = [level[i : i + 32] for i in range(0, len(level), 32)]
+            if depth > 0:
+                level = merkle_parent_level_bytes(level, executor)
+        return tree
+
+    def proof(self, index):
+        """Returns the merkle proof of the hash at index of a complete tree:
+        a (sibling hash, whether the sibling is on the right) pair per level
+        from the bottom up"""
+        if not 0 <= index < self.total:
+            raise IndexError("no hash at index {}".format(index))
+        result = []
+        for depth in range(self.max_depth, 0, -1):
+            level = self.nodes[depth]
+            sibling = index ^ 1
+            if sibling < len(level):
+                result.append((level[sibling], sibling > index))
+            else:
+                # the last hash of an odd level is paired with itself
+                result.append((level[index], True))
+            index //= 2
+        return result
+
     def up(self):
         self.current_depth -= 1
         self.current_index //= 2
@@ -71,35 +112,294 @@ class MerkleTree:
         return len(self.nodes[self.current_depth + 1]) > (self.current_index * 2 + 1)
 
     def populate_tree(self, flag_bits, hashes):
-        while self.root() is None:
-            if self.is_leaf():
-                flag_bits.pop(0)
-                self.set_current_node(hashes.pop(0))
-                self.up()
-            else:
-                left_hash = self.get_left_node()
-                if left_hash is None:
-                    if flag_bits.pop(0) == 0:
-                        self.set_current_node(hashes.pop(0))
-                        self.up()
-                    else:
-                        self.left()
-                elif self.right_exists():
-                    right_hash = self.get_right_node()
-                    if right_hash is None:
-                        self.right()
-                    else:
-                        self.set_current_node(merkle_parent(left_hash, right_hash))
-                        self.up()
+        """Fills the tree from the flag bits and hashes of a merkleblock and
+        returns the leaf hashes whose flag bit is set, see
+        partial_merkle_root. Neither argument is modified."""
+        matched = []
+        partial_merkle_root(
+            self.total,
+            hashes,
+            bit_field_to_bytes(flag_bits),
+            matched,
+            nodes=self.nodes,
+            flag_count=len(flag_bits),
+        )
+        return matched
+
+
+def build_partial_tree(tree, indexes):
+    """Returns the flag bits and binary hashes of the BIP37 partial merkle
+    tree that proves the leaves at indexes of a complete MerkleTree"""
+    # matched[depth][i] is whether node i of that depth is a matched leaf
+    # or has one below it
+    level = [False] * tree.total
+    for index in indexes:
+        level[index] = True
+    matched = [level]
+    for _ in range(tree.max_depth):
+        level = [any(level[i : i + 2]) for i in range(0, len(level), 2)]
+        matched.append(level)
+    matched.reverse()
+    flag_bits = []
+    hashes = []
+    # depth first, left before right, like populate_tree consumes them
+    stack = [(0, 0)]
+    while stack:
+        depth, index = stack.pop()
+        parent_of_match = matched[depth][index]
+        flag_bits.append(1 if parent_of_match else 0)
+        if depth == tree.max_depth or not parent_of_match:
+            hashes.append(tree.nodes[depth][index])
+        else:
+            if index * 2 + 1 < len(tree.nodes[depth + 1]):
+                stack.append((depth + 1, index * 2 + 1))
+            stack.append((depth + 1, index * 2))
+    return flag_bits, hashes
+
+
+def partial_merkle_root(
+    total, hashes, flags, matched, stack=None, nodes=None, flag_count=None
+):
+    """Returns the root of the partial merkle tree of a merkleblock of total
+    transactions, read straight from its binary hashes (merkle_root order)
+    and flags bytes. Matched leaves are appended to matched. stack is a
+    list to reuse between calls, nodes the levels of a MerkleTree to fill
+    with the hashes that are known or computed, flag_count the number of
+    flag bits if it's less than all the bits of flags.
+    Raises RuntimeError for a malformed tree."""
+    max_depth = (total - 1).bit_length()
+    if stack is None:
+        stack = []
+    else:
+        stack.clear()
+    if flag_count is None:
+        flag_count = len(flags) * 8
+    flag_index = 0
+    hash_index = 0
+    depth = 0
+    index = 0
+    try:
+        while True:
+            if flag_index == flag_count:
+                raise RuntimeError("ran out of flag bits or hashes")
+            flag_bit = flags[flag_index >> 3] >> (flag_index & 7) & 1
+            flag_index += 1
+            if depth < max_depth and flag_bit:
+                # go down to the left child, the parent waits on the stack
+                # as [depth, index, left hash]
+                stack.append([depth, index, None])
+                depth += 1
+                index *= 2
+                continue
+            h = hashes[hash_index]
+            hash_index += 1
+            if nodes is not None:
+                nodes[depth][index] = h
+            if flag_bit:
+                matched.append(h)
+            # go up while both children of the parent are known
+            while stack:
+                parent = stack[-1]
+                if parent[2] is None:
+                    parent[2] = h
+                    depth = parent[0] + 1
+                    index = parent[1] * 2 + 1
+                    # width of the child level
+                    if index < (total + (1 << max_depth - depth) - 1) >> (
+                        max_depth - depth
+                    ):
+                        break
+                    h = merkle_parent(h, h)
                 else:
-                    self.set_current_node(merkle_parent(left_hash, left_hash))
-                    self.up()
-        if len(hashes) != 0:
-            raise RuntimeError("hashes not all consumed {}".format(len(hashes)))
+                    # equal children would let a tree with a duplicated
+                    # last hash pass (CVE-2012-2459)
+                    if parent[2] == h:
+                        raise RuntimeError("duplicate hashes in the tree")
+                    h = merkle_parent(parent[2], h)
+                if nodes is not None:
+                    nodes[parent[0]][parent[1]] = h
+                stack.pop()
+            else:
+                break
+    except IndexError:
+        raise RuntimeError("ran out of flag bits or hashes")
+    if hash_index != len(hashes):
+        raise RuntimeError(
+            "hashes not all consumed {}".format(len(hashes) - hash_index)
+        )
+    if flag_index < len(flags) * 8 and flags[flag_index >> 3] >> (flag_index & 7):
+        raise RuntimeError("flag bits not all consumed")
+    for byte in flags[(flag_index + 7) >> 3 :]:
+        if byte:
+            raise RuntimeError("flag bits not all consumed")
+    return h
+
+
+def verify_partial_trees(jobs):
+    """Takes a list of (total, binary hashes, flags, binary merkle root) and
+    returns a (valid, matched binary hashes) pair for each"""
+    results = []
+    stack = []
+    for total, hashes, flags, root in jobs:
+        matched = []
+        try:
+            valid = total > 0 and (
+                partial_merkle_root(total, hashes, flags, matched, stack) == root
+            )
+        except RuntimeError:
+            valid = False
+        if not valid:
+            matched = []
+        results.append((valid, matched))
+    return results
+
+
+def verify_merkle_blocks(merkle_blocks, best_chain, processes=None):
+    """Verifies a stream of MerkleBlocks against a header chain.
+    best_chain answers `block_hash in best_chain` for the hashes of the
+    best chain, e.g. a set of them. Returns a (block hash, valid, matched
+    txids) tuple per merkle block in order, where valid means its header
+    is on the best chain and its partial tree has the header's merkle root.
+    With processes the trees are split between that many worker processes."""
+    merkle_blocks = list(merkle_blocks)
+    block_hashes = [merkle_block.hash() for merkle_block in merkle_blocks]
+    jobs = [
+        (
+            merkle_block.total,
+            [h[::-1] for h in merkle_block.hashes],
+            merkle_block.flags,
+            merkle_block.merkle_root[::-1],
+        )
+        for merkle_block in merkle_blocks
+    ]
+    if processes and processes > 1 and len(jobs) > 1:
+        size = -(-len(jobs) // processes)
+        chunks = [jobs[i : i + size] for i in range(0, len(jobs), size)]
+        with ProcessPoolExecutor(processes) as executor:
+            results = [
+                result
+                for chunk in executor.map(verify_partial_trees, chunks)
+                for result in chunk
+            ]
+    else:
+        results = verify_partial_trees(jobs)
+    report = []
+    for block_hash, (valid, matched) in zip(block_hashes, results):
+        if valid and block_hash in best_chain:
+            report.append((block_hash, True, [h[::-1] for h in matched]))
+        else:
+            report.append((block_hash, False, []))
+    return report
+
+
+def verify_proof(leaf, proof, root):
+    """Returns whether the proof from MerkleTree.proof links the binary hash
+    leaf to the merkle root"""
+    current = leaf
+    for sibling, sibling_is_right in proof:
+        if sibling_is_right:
+            current = merkle_parent(current, sibling)
+        else:
+            current = merkle_parent(sibling, current)
+    return current == root
+
+
+class MerkleTreeCache:
+    """Keeps the complete MerkleTrees of recent blocks, so that proofs for
+    transactions of the same block don't rebuild its tree.
+    Blocks beyond max_size are evicted least recently used first."""
+
+    max_size = 64
+    # block hash -> MerkleTree
+    cache = OrderedDict()
+
+    @classmethod
+    def get(cls, block_hash, hashes):
+        """Returns the tree of the block, built from its binary hashes
+        (merkle_root order) if it isn't cached yet"""
+        tree = cls.cache.get(block_hash)
+        if tree is not None:
+            cls.cache.move_to_end(block_hash)
+            return tree
+        tree = MerkleTree.from_hashes(hashes)
+        cls.cache[block_hash] = tree
+        while len(cls.cache) > cls.max_size:
+            cls.cache.popitem(last=False)
+        return tree
+
+    @classmethod
+    def clear(cls):
+        cls.cache.clear()
+
 
-        for flag_bit in flag_bits:
-            if flag_bit != 0:
-                raise RuntimeError("flag bits not all consumed")
+class IncrementalMerkleTree:
+    """Merkle tree of a block template that keeps its internal nodes, so
+    that changing or appending a hash only rehashes its path to the root.
+    Hashes are binary, in merkle_root order."""
+
+    def __init__(self, hashes=()):
+        # levels[0] are the hashes, levels[-1] holds the root
+        self.levels = [list(hashes)]
+        level = b"".join(self.levels[0])
+        while len(level) > 32:
+            level = merkle_parent_level_bytes(level)
+            self.levels.append([level[i : i + 32] for i in range(0, len(level), 32)])
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def root(self):
+        """Returns the merkle root, None for an empty tree"""
+        top = self.levels[-1]
+        if not top:
+            return None
+        return top[0]
+
+    def rehash_path(self, index):
+        """Recomputes the parents of the hash at index up to the root"""
+        depth = 0
+        while len(self.levels[depth]) > 1:
+            level = self.levels[depth]
+            left = index - index % 2
+            if left + 1 < len(level):
+                parent = merkle_parent(level[left], level[left + 1])
+            else:
+                # the last hash of an odd level is paired with itself
+                parent = merkle_parent(level[left], level[left])
+            index //= 2
+            depth += 1
+            if depth == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[depth]
+            if index < len(parents):
+                parents[index] = parent
+            else:
+                parents.append(parent)
+
+    def update(self, index, new_hash):
+        """Replaces the hash at index, e.g. the coinbase after an extranonce
+        change"""
+        self.levels[0][index] = new_hash
+        self.rehash_path(index)
+
+    def append(self, new_hash):
+        """Adds a hash after the last one"""
+        self.levels[0].append(new_hash)
+        self.rehash_path(len(self.levels[0]) - 1)
+
+    def coinbase_branch(self):
+        """Returns the hashes the first hash is combined with on its way to
+        the root, see coinbase_merkle_root"""
+        return [level[1] if len(level) > 1 else level[0] for level in self.levels[:-1]]
+
+
+def coinbase_merkle_root(coinbase_hash, branch):
+    """Returns the merkle root for a new coinbase hash given the
+    coinbase_branch of the template, in len(branch) hashes"""
+    current = coinbase_hash
+    for sibling in branch:
+        current = merkle_parent(current, sibling)
+    return current
 
 
 class MerkleBlock:
@@ -130,57 +430,113 @@ class MerkleBlock:
         for h in self.hashes:
             result += "\t{}\n".format(h.hex())
         result += "{}".format(self.flags.hex())
+        return result
 
     @classmethod
     def parse(cls, s):
         """Takes a byte stream and parses a merkle block. Returns a Merkle Block object"""
-        # version - 4 bytes, Little-Endian integer
-        version = little_endian_to_int(s.read(4))
-        # prev_block - 32 bytes (use [::-1])
-        prev_block = s.read(32)[::-1]
-        # merkle_root - 32 bytes (use [::-1])
-        merkle_root = s.read(32)[::-1]
-        # timestamp - 4 bytes, Little-Endian integer
-        timestamp = little_endian_to_int(s.read(4))
-        # bits - 4 bytes
-        bits = s.read(4)
-        # nonce - 4 bytes
-        nonce = s.read(4)
+        return parse_stream(s, cls.parse_from)
+
+    @classmethod
+    def parse_from(cls, buffer, offset=0):
+        """Parses the merkle block at offset of buffer, returns it and the
+        offset right after it"""
+        # the block header comes first
+        header, offset = Block.parse_from(buffer, offset)
         # total transactions in block - 4 bytes, Little-Endian integer
-        total = little_endian_to_int(s.read(4))
+        total = UINT32.unpack_from(buffer, offset)[0]
         # number of transaction hashes - varint
-        num_hashes = read_varint(s)
+        num_hashes, offset = unpack_varint_from(buffer, offset + 4)
         # each transaction is 32 bytes, Little-Endian
         hashes = []
-        for _ in num_hashes:
-            hashes.append(little_endian_to_int(s.read(32)[::-1]))
+        for _ in range(num_hashes):
+            hashes.append(bytes(buffer[offset : offset + 32])[::-1])
+            offset += 32
         # length of flags field - varint
-        flags_length = read_varint(s)
+        flags_length, offset = unpack_varint_from(buffer, offset)
         # read the flags field
-        flags = s.read(flags_length)
+        flags = bytes(buffer[offset : offset + flags_length])
+        if len(flags) != flags_length:
+            raise SyntaxError("merkleblock ended before its flags")
         # initialize class
-        return cls(
-            version,
-            prev_block,
-            merkle_root,
-            timestamp,
-            bits,
-            nonce,
+        merkle_block = cls(
+            header.version,
+            header.prev_block,
+            header.merkle_root,
+            header.timestamp,
+            header.bits,
+            header.nonce,
             total,
             hashes,
             flags,
         )
+        return merkle_block, offset + flags_length
 
-    def is_valid(self):
-        """Verifies whether the merkle tree information validates to the merkle root"""
-        # convert the flags field to a bit field
-        flag_bits = bytes_to_bit_field(self.flags)
+    @classmethod
+    def from_block(cls, block, txids):
+        """Builds the merkle block of a Block with tx_hashes that proves the
+        transactions whose hashes are in txids. The tree of the block comes
+        from MerkleTreeCache, so serving many filters against one block
+        only hashes it once."""
+        tree = MerkleTreeCache.get(block.hash(), [h[::-1] for h in block.tx_hashes])
+        indexes = [i for i, h in enumerate(block.tx_hashes) if h in txids]
+        flag_bits, hashes = build_partial_tree(tree, indexes)
+        return cls(
+            block.version,
+            block.prev_block,
+            block.merkle_root,
+            block.timestamp,
+            block.bits,
+            block.nonce,
+            len(block.tx_hashes),
+            [h[::-1] for h in hashes],
+            bit_field_to_bytes(flag_bits),
+        )
+
+    def header(self):
+        """Returns the Block of the header of this merkle block"""
+        return Block(
+            self.version,
+            self.prev_block,
+            self.merkle_root,
+            self.timestamp,
+            self.bits,
+            self.nonce,
+        )
+
+    def serialize(self):
+        """Returns the byte serialization of the merkle block"""
+        result = bytearray(
+            80
+            + 4
+            + varint_size(len(self.hashes))
+            + 32 * len(self.hashes)
+            + varint_size(len(self.flags))
+            + len(self.flags)
+        )
+        offset = self.header().serialize_into(result, 0)
+        UINT32.pack_into(result, offset, self.total)
+        offset = pack_varint_into(result, offset + 4, len(self.hashes))
+        for h in self.hashes:
+            offset = pack_bytes_into(result, offset, h[::-1])
+        offset = pack_varint_into(result, offset, len(self.flags))
+        pack_bytes_into(result, offset, self.flags)
+        return bytes(result)
+
+    def hash(self):
+        """Returns the hash of the block header of this merkle block"""
+        return self.header().hash()
+
+    def validate(self):
+        """Returns whether the merkle tree information validates to the
+        merkle root and the matched transaction hashes, in the order of
+        self.hashes. Malformed trees are invalid and match nothing."""
         # reverse self.hashes for the merkle root calculation
         hashes = [h[::-1] for h in self.hashes]
-        # initialize the merkle tree
-        merkle_tree = MerkleTree(self.total)
-        # populate the tree with flag bits and hashes
-        merkle_tree.populate_tree(flag_bits, hashes)
-        # check if the computed root reversed is the same as the merkle root
-        # return whether self.merkle_root is the same
-        return merkle_tree.root()[::-1] == self.merkle_root
+        job = (self.total, hashes, self.flags, self.merkle_root[::-1])
+        valid, matched = verify_partial_trees([job])[0]
+        return valid, [h[::-1] for h in matched]
+
+    def is_valid(self):
+        """Verifies whether the merkle tree information validates to the merkle root"""
+        return self.validate()[0]
@@ -4,8 +4,17 @@ from io import BytesIO
 import socket
 
 from bitcoin_protocol.block import Block
+from bitcoin_protocol.codec import (
+    pack_bytes_into,
+    pack_varint_into,
+    parse_stream,
+    unpack_varint_from,
+    varint_size,
+    UINT16_BE,
+    UINT32,
+    UINT64,
+)
 from bitcoin_protocol.helper import (
-    little_endian_to_int,
     int_to_little_endian,
     read_varint,
     encode_varint,
@@ -32,10 +41,13 @@ class NetworkEnvelope:
     @classmethod
     def parse(cls, s, testnet=False):
         """Takes a stream and creates a NetworkEnvelope"""
-        # First 4 bytes are the network magic
-        magic = s.read(4)
-        if magic == b"":
+        # the 24 byte header is read at once
+        header = s.read(24)
+        # a connection that drops before the whole header arrived
+        if len(header) < 24:
             raise IOError("Connection reset!")
+        # First 4 bytes are the network magic
+        magic = header[:4]
         if testnet:
             expected_magic = TESTNET_NETWORK_MAGIC
         else:
@@ -47,15 +59,15 @@ class NetworkEnvelope:
 
         # next 12 bytes are the command field
         # more details about each commands https://en.bitcoin.it/wiki/Protocol_documentation
-        command = s.read(12)
+        command = header[4:16]
         # remove trailing x00 bytes from command
         command = command.strip(b"\x00")
 
         # 4 bytes payload length in little endian
-        payload_length = little_endian_to_int(s.read(4))
+        payload_length = UINT32.unpack_from(header, 16)[0]
 
         # 4 bytes payload checksum first 4 bytes of hash256 of the payload
-        payload_checksum = s.read(4)
+        payload_checksum = header[20:24]
 
         # payload
         payload = s.read(payload_length)
@@ -70,19 +82,20 @@ class NetworkEnvelope:
 
     def serialize(self):
         """Returns the byte serialization of the entire network message"""
+        result = bytearray(24 + len(self.payload))
         # add the network magic
-        result = self.magic
+        result[:4] = self.magic
         # command 12 bytes
-        # fill with 0's
-        result += self.command + b"\x00" * (12 - len(self.command))
+        # the rest of the field stays filled with 0's
+        pack_bytes_into(result, 4, self.command)
         # payload length 4 bytes, little endian
-        result += int_to_little_endian(len(self.payload), 4)
+        UINT32.pack_into(result, 16, len(self.payload))
         # checksum 4 bytes, first four of hash256 of payload
-        result += hash256(self.payload)[:4]
+        result[20:24] = hash256(self.payload)[:4]
         # payload
-        result += self.payload
+        result[24:] = self.payload
 
-        return result
+        return bytes(result)
 
     def stream(self):
         """Returns a stream for parsing the payload"""
@@ -137,71 +150,99 @@ class VersionMessage:
 
     @classmethod
     def parse(cls, s):
-        version = little_endian_to_int(s.read(4))
-        services = little_endian_to_int(s.read(8))
-        timestamp = little_endian_to_int(s.read(8))
-        receiver_services = little_endian_to_int(s.read(8))
-        receiver_ip = s.read(16).strip(b"\x00").strip(b"\xff")
-        receiver_port = int.from_bytes(s.read(2), "big")
-
-        sender_services = little_endian_to_int(s.read(8))
-        sender_ip = s.read(16).strip(b"\x00").strip(b"\xff")
-        sender_port = int.from_bytes(s.read(2), "big")
-        nonce = s.read(8)
-        user_agent_len = read_varint(s)
-        user_agent = s.read(user_agent_len)
-        latest_block = little_endian_to_int(s.read(4))
-        relay = s.read(1) == b"\x01"
-
-        return cls(
-            version,
-            services,
-            timestamp,
-            receiver_services,
-            receiver_ip,
-            receiver_port,
-            sender_services,
-            sender_ip,
-            sender_port,
-            nonce,
-            user_agent,
-            latest_block,
-            relay,
+        return parse_stream(s, cls.parse_from)
+
+    @classmethod
+    def parse_from(cls, buffer, offset=0):
+        """Parses the version message at offset of buffer, returns it and
+        the offset right after it"""
+        version = UINT32.unpack_from(buffer, offset)[0]
+        services = UINT64.unpack_from(buffer, offset + 4)[0]
+        timestamp = UINT64.unpack_from(buffer, offset + 12)[0]
+        receiver_services = UINT64.unpack_from(buffer, offset + 20)[0]
+        receiver_ip = (
+            bytes(buffer[offset + 28 : offset + 44]).strip(b"\x00").strip(b"\xff")
+        )
+        receiver_port = UINT16_BE.unpack_from(buffer, offset + 44)[0]
+
+        sender_services = UINT64.unpack_from(buffer, offset + 46)[0]
+        sender_ip = (
+            bytes(buffer[offset + 54 : offset + 70]).strip(b"\x00").strip(b"\xff")
+        )
+        sender_port = UINT16_BE.unpack_from(buffer, offset + 70)[0]
+        nonce = bytes(buffer[offset + 72 : offset + 80])
+        user_agent_len, offset = unpack_varint_from(buffer, offset + 80)
+        user_agent = bytes(buffer[offset : offset + user_agent_len])
+        offset += user_agent_len
+        latest_block = UINT32.unpack_from(buffer, offset)[0]
+        offset += 4
+        # relay is optional, missing means False
+        relay = offset < len(buffer) and buffer[offset] == 1
+        if offset < len(buffer):
+            offset += 1
+
+        return (
+            cls(
+                version,
+                services,
+                timestamp,
+                receiver_services,
+                receiver_ip,
+                receiver_port,
+                sender_services,
+                sender_ip,
+                sender_port,
+                nonce,
+                user_agent,
+                latest_block,
+                relay,
+            ),
+            offset,
         )
 
     def serialize(self):
         """Serialize this message to send over the network"""
+        user_agent_len = len(self.user_agent)
+        result = bytearray(
+            72
+            + len(self.receiver_ip)
+            + len(self.sender_ip)
+            + varint_size(user_agent_len)
+            + user_agent_len
+            + 4
+            + 1
+        )
         # version is 4 bytes little endian
-        result = int_to_little_endian(self.version, 4)
+        UINT32.pack_into(result, 0, self.version)
         # services is 8 bytes little endian
-        result += int_to_little_endian(self.services, 8)
+        UINT64.pack_into(result, 4, self.services)
         # timestamp is 8 bytes little endian
-        result += int_to_little_endian(self.timestamp, 8)
+        UINT64.pack_into(result, 12, self.timestamp)
         # receiver services is 8 bytes little endian
-        result += int_to_little_endian(self.receiver_services, 8)
+        UINT64.pack_into(result, 20, self.receiver_services)
         # IPV4 is 10 00 bytes and 2 ff bytes then receiver ip
-        result += (b"\x00" * 10) + b"\xff\xff" + self.receiver_ip
-        # receiver port is 2 bytes, little endian should be 0
-        result += self.receiver_port.to_bytes(2, "big")
+        result[38:40] = b"\xff\xff"
+        offset = pack_bytes_into(result, 40, self.receiver_ip)
+        # receiver port is 2 bytes, big endian
+        UINT16_BE.pack_into(result, offset, self.receiver_port)
         # sender services is 8 bytes little endian
-        result += int_to_little_endian(self.sender_services, 8)
+        UINT64.pack_into(result, offset + 2, self.sender_services)
         # IPV4 is 10 00 bytes and 2 ff bytes then sender ip
-        result += (b"\x00" * 10) + b"\xff\xff" + self.sender_ip
-        # sender port is 2 bytes, little endian should be 0
-        result += self.sender_port.to_bytes(2, "big")
+        result[offset + 20 : offset + 22] = b"\xff\xff"
+        offset = pack_bytes_into(result, offset + 22, self.sender_ip)
+        # sender port is 2 bytes, big endian
+        UINT16_BE.pack_into(result, offset, self.sender_port)
         # nonce should be 8 bytes
-        result += self.nonce
+        offset = pack_bytes_into(result, offset + 2, self.nonce)
         # useragent is a variable string, so varint first
-        result += encode_varint(len(self.user_agent))
-        result += self.user_agent
+        offset = pack_varint_into(result, offset, user_agent_len)
+        offset = pack_bytes_into(result, offset, self.user_agent)
         # latest block is 4 bytes little endian
-        result += int_to_little_endian(self.latest_block, 4)
+        UINT32.pack_into(result, offset, self.latest_block)
         # relay is 00 if false, 01 if true
         if self.relay:
-            result += b"\x01"
-        else:
-            result += b"\x00"
-        return result
+            result[offset + 4] = 1
+        return bytes(result)
 
 
 class VerAckMessage:
@@ -1,8 +1,10 @@
 import hashlib
 
+from functools import lru_cache
 from logging import getLogger
 
 from ecc import (
+    N,
     S256Point,
     Signature,
 )
@@ -15,8 +17,13 @@ from helper import (
 
 LOGGER = getLogger(__name__)
 
+MAX_PUBKEYS_PER_MULTISIG = 20
+
 
 def encode_num(num):
+    encoded = ENCODED_NUMS.get(num)
+    if encoded is not None:
+        return encoded
     if num == 0:
         return b''
     abs_num = abs(num)
@@ -38,7 +45,15 @@ def encode_num(num):
     return bytes(result)
 
 
+# encode_num results for OP_1NEGATE through every element size up to 520
+ENCODED_NUMS = {}
+ENCODED_NUMS.update((n, encode_num(n)) for n in range(-520, 521))
+
+
 def decode_num(element):
+    # arithmetic ops leave their results on the stack as ints
+    if type(element) == int:
+        return element
     if element == b'':
         return 0
     # reverse for big endian
@@ -59,93 +74,101 @@ def decode_num(element):
         return result
 
 
+def encode_element(element):
+    '''Returns the bytes of a stack element, which is an int if it was
+    left there by an arithmetic op'''
+    if type(element) == int:
+        return encode_num(element)
+    return element
+
+
 def op_0(stack):
-    stack.append(encode_num(0))
+    stack.append(0)
     return True
 
 
 def op_1negate(stack):
-    stack.append(encode_num(-1))
+    stack.append(-1)
     return True
 
 
 def op_1(stack):
-    stack.append(encode_num(1))
+    stack.append(1)
     return True
 
 
 def op_2(stack):
-    stack.append(encode_num(2))
+    stack.append(2)
     return True
 
 
 def op_3(stack):
-    stack.append(encode_num(3))
+    stack.append(3)
     return True
 
 
 def op_4(stack):
-    stack.append(encode_num(4))
+    stack.append(4)
     return True
 
 
 def op_5(stack):
-    stack.append(encode_num(5))
+    stack.append(5)
     return True
 
 
 def op_6(stack):
-    stack.append(encode_num(6))
+    stack.append(6)
     return True
 
 
 def op_7(stack):
-    stack.append(encode_num(7))
+    stack.append(7)
     return True
 
 
 def op_8(stack):
-    stack.append(encode_num(8))
+    stack.append(8)
     return True
 
 
 def op_9(stack):
-    stack.append(encode_num(9))
+    stack.append(9)
     return True
 
 
 def op_10(stack):
-    stack.append(encode_num(10))
+    stack.append(10)
     return True
 
 
 def op_11(stack):
-    stack.append(encode_num(11))
+    stack.append(11)
     return True
 
 
 def op_12(stack):
-    stack.append(encode_num(12))
+    stack.append(12)
     return True
 
 
 def op_13(stack):
-    stack.append(encode_num(13))
+    stack.append(13)
     return True
 
 
 def op_14(stack):
-    stack.append(encode_num(14))
+    stack.append(14)
     return True
 
 
 def op_15(stack):
-    stack.append(encode_num(15))
+    stack.append(15)
     return True
 
 
 def op_16(stack):
-    stack.append(encode_num(16))
+    stack.append(16)
     return True
 
 
@@ -153,78 +176,6 @@ def op_nop(stack):
     return True
 
 
-def op_if(stack, items):
-    if len(stack) < 1:
-        return False
-    # go through and re-make the items array based on the top stack element
-    true_items = []
-    false_items = []
-    current_array = true_items
-    found = False
-    num_endifs_needed = 1
-    while len(items) > 0:
-        item = items.pop(0)
-        if item in (99, 100):
-            # nested if, we have to go another endif
-            num_endifs_needed += 1
-            current_array.append(item)
-        elif num_endifs_needed == 1 and item == 103:
-            current_array = false_items
-        elif item == 104:
-            if num_endifs_needed == 1:
-                found = True
-                break
-            else:
-                num_endifs_needed -= 1
-                current_array.append(item)
-        else:
-            current_array.append(item)
-    if not found:
-        return False
-    element = stack.pop()
-    if decode_num(element) == 0:
-        items[:0] = false_items
-    else:
-        items[:0] = true_items
-    return True
-
-
-def op_notif(stack, items):
-    if len(stack) < 1:
-        return False
-    # go through and re-make the items array based on the top stack element
-    true_items = []
-    false_items = []
-    current_array = true_items
-    found = False
-    num_endifs_needed = 1
-    while len(items) > 0:
-        item = items.pop(0)
-        if item in (99, 100):
-            # nested if, we have to go another endif
-            num_endifs_needed += 1
-            current_array.append(item)
-        elif num_endifs_needed == 1 and item == 103:
-            current_array = false_items
-        elif item == 104:
-            if num_endifs_needed == 1:
-                found = True
-                break
-            else:
-                num_endifs_needed -= 1
-                current_array.append(item)
-        else:
-            current_array.append(item)
-    if not found:
-        return False
-    element = stack.pop()
-    if decode_num(element) == 0:
-        items[:0] = true_items
-    else:
-        items[:0] = false_items
-    return True
-
-
 def op_verify(stack):
     if len(stack) < 1:
         return False
@@ -304,7 +255,7 @@ def op_ifdup(stack):
 
 
 def op_depth(stack):
-    stack.append(encode_num(len(stack)))
+    stack.append(len(stack))
     return True
 
 
@@ -340,7 +291,7 @@ def op_pick(stack):
     if len(stack) < 1:
         return False
     n = decode_num(stack.pop())
-    if len(stack) < n + 1:
+    if n < 0 or len(stack) < n + 1:
         return False
     stack.append(stack[-n - 1])
     return True
@@ -350,7 +301,7 @@ def op_roll(stack):
     if len(stack) < 1:
         return False
     n = decode_num(stack.pop())
-    if len(stack) < n + 1:
+    if n < 0 or len(stack) < n + 1:
         return False
     if n == 0:
         return True
@@ -382,7 +333,7 @@ def op_tuck(stack):
 def op_size(stack):
     if len(stack) < 1:
         return False
-    stack.append(encode_num(len(stack[-1])))
+    stack.append(len(encode_element(stack[-1])))
     return True
 
 
@@ -391,10 +342,14 @@ def op_equal(stack):
         return False
     element1 = stack.pop()
     element2 = stack.pop()
+    # ints have a single encoding so only mixed pairs need converting
+    if type(element1) != type(element2):
+        element1 = encode_element(element1)
+        element2 = encode_element(element2)
     if element1 == element2:
-        stack.append(encode_num(1))
+        stack.append(1)
     else:
-        stack.append(encode_num(0))
+        stack.append(0)
     return True
 
 
@@ -406,7 +361,7 @@ def op_1add(stack):
     if len(stack) < 1:
         return False
     element = decode_num(stack.pop())
-    stack.append(encode_num(element + 1))
+    stack.append(element + 1)
     return True
 
 
@@ -414,7 +369,7 @@ def op_1sub(stack):
     if len(stack) < 1:
         return False
     element = decode_num(stack.pop())
-    stack.append(encode_num(element - 1))
+    stack.append(element - 1)
     return True
 
 
@@ -422,7 +377,7 @@ def op_negate(stack):
     if len(stack) < 1:
         return False
     element = decode_num(stack.pop())
-    stack.append(encode_num(-element))
+    stack.append(-element)
     return True
 
 
@@ -431,9 +386,9 @@ def op_abs(stack):
         return False
     element = decode_num(stack.pop())
     if element < 0:
-        stack.append(encode_num(-element))
+        stack.append(-element)
     else:
-        stack.append(encode_num(element))
+        stack.append(element)
     return True
 
 
@@ -442,9 +397,9 @@ def op_not(stack):
         return False
     element = stack.pop()
     if decode_num(element) == 0:
-        stack.append(encode_num(1))
+        stack.append(1)
     else:
-        stack.append(encode_num(0))
+        stack.append(0)
     return True
 
 
@@ -453,9 +408,9 @@ def op_0notequal(stack):
         return False
     element = stack.pop()
     if decode_num(element) == 0:
-        stack.append(encode_num(0))
+        stack.append(0)
     else:
-        stack.append(encode_num(1))
+        stack.append(1)
     return True
 
 
@@ -464,7 +419,7 @@ def op_add(stack):
         return False
     element1 = decode_num(stack.pop())
     element2 = decode_num(stack.pop())
-    stack.append(encode_num(element1 + element2))
+    stack.append(element1 + element2)
     return True
 
 
@@ -473,7 +428,7 @@ def op_sub(stack):
         return False
     element1 = decode_num(stack.pop())
     element2 = decode_num(stack.pop())
-    stack.append(encode_num(element2 - element1))
+    stack.append(element2 - element1)
     return True
 
 
@@ -483,9 +438,9 @@ def op_booland(stack):
     element1 = decode_num(stack.pop())
     element2 = decode_num(stack.pop())
     if element1 and element2:
-        stack.append(encode_num(1))
+        stack.append(1)
     else:
-        stack.append(encode_num(0))
+        stack.append(0)
     return True
 
 
@@ -495,9 +450,9 @@ def op_boolor(stack):
     element1 = decode_num(stack.pop())
     element2 = decode_num(stack.pop())
     if element1 or element2:
-        stack.append(encode_num(1))
+        stack.append(1)
     else:
-        stack.append(encode_num(0))
+        stack.append(0)
     return True
 
 
@@ -507,9 +462,9 @@ def op_numequal(stack):
     element1 = decode_num(stack.pop())
     element2 = decode_num(stack.pop())
     if element1 == element2:
-        stack.append(encode_num(1))
+        stack.append(1)
     else:
-        stack.append(encode_num(0))
+        stack.append(0)
     return True
 
 
@@ -523,9 +478,9 @@ def op_numnotequal(stack):
     element1 = decode_num(stack.pop())
     element2 = decode_num(stack.pop())
     if element1 == element2:
-        stack.append(encode_num(0))
+        stack.append(0)
     else:
-        stack.append(encode_num(1))
+        stack.append(1)
     return True
 
 
@@ -535,9 +490,9 @@ def op_lessthan(stack):
     element1 = decode_num(stack.pop())
     element2 = decode_num(stack.pop())
     if element2 < element1:
-        stack.append(encode_num(1))
+        stack.append(1)
     else:
-        stack.append(encode_num(0))
+        stack.append(0)
     return True
 
 
@@ -547,9 +502,9 @@ def op_greaterthan(stack):
     element1 = decode_num(stack.pop())
     element2 = decode_num(stack.pop())
     if element2 > element1:
-        stack.append(encode_num(1))
+        stack.append(1)
     else:
-        stack.append(encode_num(0))
+        stack.append(0)
     return True
 
 
@@ -559,9 +514,9 @@ def op_lessthanorequal(stack):
     element1 = decode_num(stack.pop())
     element2 = decode_num(stack.pop())
     if element2 <= element1:
-        stack.append(encode_num(1))
+        stack.append(1)
     else:
-        stack.append(encode_num(0))
+        stack.append(0)
     return True
 
 
@@ -571,9 +526,9 @@ def op_greaterthanorequal(stack):
     element1 = decode_num(stack.pop())
     element2 = decode_num(stack.pop())
     if element2 >= element1:
-        stack.append(encode_num(1))
+        stack.append(1)
     else:
-        stack.append(encode_num(0))
+        stack.append(0)
     return True
 
 
@@ -583,9 +538,9 @@ def op_min(stack):
     element1 = decode_num(stack.pop())
     element2 = decode_num(stack.pop())
     if element1 < element2:
-        stack.append(encode_num(element1))
+        stack.append(element1)
     else:
-        stack.append(encode_num(element2))
+        stack.append(element2)
     return True
 
 
@@ -595,9 +550,9 @@ def op_max(stack):
     element1 = decode_num(stack.pop())
     element2 = decode_num(stack.pop())
     if element1 > element2:
-        stack.append(encode_num(element1))
+        stack.append(element1)
     else:
-        stack.append(encode_num(element2))
+        stack.append(element2)
     return True
 
 
@@ -608,16 +563,16 @@ def op_within(stack):
     minimum = decode_num(stack.pop())
     element = decode_num(stack.pop())
     if element >= minimum and element < maximum:
-        stack.append(encode_num(1))
+        stack.append(1)
     else:
-        stack.append(encode_num(0))
+        stack.append(0)
     return True
 
 
 def op_ripemd160(stack):
     if len(stack) < 1:
         return False
-    element = stack.pop()
+    element = encode_element(stack.pop())
     stack.append(hashlib.new('ripemd160', element).digest())
     return True
 
@@ -625,7 +580,7 @@ def op_ripemd160(stack):
 def op_sha1(stack):
     if len(stack) < 1:
         return False
-    element = stack.pop()
+    element = encode_element(stack.pop())
     stack.append(hashlib.sha1(element).digest())
     return True
 
@@ -633,7 +588,7 @@ def op_sha1(stack):
 def op_sha256(stack):
     if len(stack) < 1:
         return False
-    element = stack.pop()
+    element = encode_element(stack.pop())
     stack.append(hashlib.sha256(element).digest())
     return True
 
@@ -643,7 +598,7 @@ def op_hash160(stack):
     if len(stack) < 1:
         return False
     # pop off the top element from the stack
-    element = stack.pop()
+    element = encode_element(stack.pop())
     # push a hash160 of the popped off element to the stack
     h160 = hash160(element)
     stack.append(h160)
@@ -653,33 +608,60 @@ def op_hash160(stack):
 def op_hash256(stack):
     if len(stack) < 1:
         return False
-    element = stack.pop()
+    element = encode_element(stack.pop())
     stack.append(hash256(element))
     return True
 
 
+@lru_cache(maxsize=4096)
+def parse_sec_pubkey(sec_pubkey):
+    '''S256Point.parse, cached as the same pubkeys come up again and again'''
+    return S256Point.parse(sec_pubkey)
+
+
+@lru_cache(maxsize=16384)
+def check_signature(sec_pubkey, der_signature, z):
+    '''Returns whether der_signature (without the hash_type) is a valid
+    signature of z for sec_pubkey.
+    Raises ValueError or SyntaxError if either can't be parsed.'''
+    point = parse_sec_pubkey(sec_pubkey)
+    sig = Signature.parse(der_signature)
+    return point.verify(z, sig)
+
+
+@lru_cache(maxsize=4096)
+def recover_signature_points(der_signature, z):
+    '''Returns the points der_signature (without the hash_type) is a valid
+    signature of z for, or None if r or s is out of range so they can't be
+    recovered.
+    Raises ValueError or SyntaxError if der_signature can't be parsed.'''
+    sig = Signature.parse(der_signature)
+    if not 0 < sig.r < N or not 0 < sig.s < N:
+        return None
+    points = S256Point.recover_many([(z, sig, 0), (z, sig, 1)])
+    return [point for point in points if point is not None]
+
+
 def op_checksig(stack, z):
     # check that there are at least 2 elements on the stack
     if len(stack) < 2:
         return False
     # the top element of the stack is the SEC pubkey
-    sec_pubkey = stack.pop()
+    sec_pubkey = encode_element(stack.pop())
     # the next element of the stack is the DER signature
     # take off the last byte of the signature as that's the hash_type
-    der_signature = stack.pop()[:-1]
-    # parse the serialized pubkey and signature into objects
+    der_signature = encode_element(stack.pop())[:-1]
+    # parse the pubkey and signature and verify
     try:
-        point = S256Point.parse(sec_pubkey)
-        sig = Signature.parse(der_signature)
+        valid = check_signature(sec_pubkey, der_signature, z)
     except (ValueError, SyntaxError) as e:
         LOGGER.info(e)
         return False
-    # verify the signature using S256Point.verify()
     # push an encoded 1 or 0 depending on whether the signature verified
-    if point.verify(z, sig):
-        stack.append(encode_num(1))
+    if valid:
+        stack.append(1)
     else:
-        stack.append(encode_num(0))
+        stack.append(0)
     return True
 
 
@@ -691,42 +673,50 @@ def op_checkmultisig(stack, z):
     if len(stack) < 1:
         return False
     n = decode_num(stack.pop())
-    if len(stack) < n + 1:
+    if n < 0 or n > MAX_PUBKEYS_PER_MULTISIG or len(stack) < n + 1:
         return False
     sec_pubkeys = []
     for _ in range(n):
-        sec_pubkeys.append(stack.pop())
+        sec_pubkeys.append(encode_element(stack.pop()))
     m = decode_num(stack.pop())
-    if len(stack) < m + 1:
+    if m < 0 or m > n or len(stack) < m + 1:
         return False
     der_signatures = []
     for _ in range(m):
         # signature is assumed to be using SIGHASH_ALL
-        der_signatures.append(stack.pop()[:-1])
+        der_signatures.append(encode_element(stack.pop())[:-1])
     # OP_CHECKMULTISIG bug
     stack.pop()
+    # the signatures have to be in the same order as their pubkeys, each
+    # pubkey is only parsed once a signature gets to it
+    key_index = 0
     try:
-        # parse all the points
-        points = [S256Point.parse(sec) for sec in sec_pubkeys]
-        # parse all the signatures
-        sigs = [Signature.parse(der) for der in der_signatures]
-        # loop through the signatures
-        for sig in sigs:
-            # if we have no more points, signatures are no good
-            if len(points) == 0:
-                LOGGER.info("signatures no good or not in right order")
-                return False
-            # we loop until we find the point which works with this signature
-            while points:
-                # get the current point from the list of points
-                point = points.pop(0)
-                # we check if this signature goes with the current point
-                if point.verify(z, sig):
+        for sig_index, der_signature in enumerate(der_signatures):
+            # the keys this signature is valid for, recovered the first time
+            # a pubkey is compared which is cheaper than verifying against
+            # every pubkey
+            recovered = False
+            # we loop until we find the pubkey which works with this signature
+            while True:
+                # if we have fewer pubkeys than signatures left, they're no good
+                if n - key_index < m - sig_index:
+                    LOGGER.info("signatures no good or not in right order")
+                    return False
+                sec_pubkey = sec_pubkeys[key_index]
+                key_index += 1
+                if not recovered:
+                    points = recover_signature_points(der_signature, z)
+                    recovered = True
+                if points is None:
+                    valid = check_signature(sec_pubkey, der_signature, z)
+                else:
+                    valid = parse_sec_pubkey(sec_pubkey) in points
+                if valid:
                     break
-        # the signatures are valid, so push a 1 to the stack
-        stack.append(encode_num(1))
     except (ValueError, SyntaxError):
         return False
+    # the signatures are valid, so push a 1 to the stack
+    stack.append(1)
     return True
 
 
@@ -789,8 +779,6 @@ OP_CODE_FUNCTIONS = {
     95: op_15,
     96: op_16,
     97: op_nop,
-    99: op_if,
-    100: op_notif,
     105: op_verify,
     106: op_return,
     107: op_toaltstack,
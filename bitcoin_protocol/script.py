@@ -1,16 +1,31 @@
-from io import BytesIO
+from functools import lru_cache
 from logging import getLogger
+import struct
+from time import perf_counter
 
+from codec import (
+    pack_varint_into,
+    parse_stream,
+    unpack_varint_from,
+    varint_size,
+    UINT16,
+)
 from helper import (
-    encode_varint,
-    int_to_little_endian,
-    little_endian_to_int,
-    read_varint,
+    encode_bech32_address,
+    h160_to_p2pkh_address,
+    h160_to_p2sh_address,
+    hash160,
 )
 from op import (
+    decode_num,
+    encode_element,
+    op_checkmultisig,
+    op_checksig,
     op_equal,
     op_hash160,
+    op_nop,
     op_verify,
+    MAX_PUBKEYS_PER_MULTISIG,
     OP_CODE_FUNCTIONS,
     OP_CODE_NAMES,
 )
@@ -28,6 +43,254 @@ def p2sh_script(h160):
 
 LOGGER = getLogger(__name__)
 
+# consensus limits enforced by Script.evaluate
+MAX_SCRIPT_SIZE = 10000
+MAX_SCRIPT_ELEMENT_SIZE = 520
+MAX_OPS_PER_SCRIPT = 201
+MAX_STACK_SIZE = 1000
+
+# kinds of compiled instructions, see compile_cmds
+INSTRUCTION_PUSH = 0
+INSTRUCTION_OP = 1
+INSTRUCTION_ALTSTACK = 2
+INSTRUCTION_SIG = 3
+INSTRUCTION_IF = 4
+INSTRUCTION_NOTIF = 5
+INSTRUCTION_ELSE = 6
+INSTRUCTION_P2SH = 7
+INSTRUCTION_BAD = 8
+
+
+def check_limits(cmds):
+    '''Raises ValueError if the cmds are over the size, element size or
+    op count limits'''
+    size = 0
+    op_count = 0
+    for cmd in cmds:
+        if type(cmd) == int:
+            size += 1
+            # pushes up to OP_16 don't count towards the op limit
+            if cmd > 96:
+                op_count += 1
+        else:
+            length = len(cmd)
+            if length > MAX_SCRIPT_ELEMENT_SIZE:
+                raise ValueError('element too large: {}'.format(length))
+            if length <= 75:
+                size += 1 + length
+            elif length < 0x100:
+                size += 2 + length
+            else:
+                size += 3 + length
+    if size > MAX_SCRIPT_SIZE:
+        raise ValueError('script too large: {}'.format(size))
+    if op_count > MAX_OPS_PER_SCRIPT:
+        raise ValueError('too many ops: {}'.format(op_count))
+
+
+def compile_cmds(cmds):
+    '''Turns a list of cmds into a list of (kind, operation, arg)
+    instructions for Script.evaluate.
+    Pushes carry their element as arg, opcodes carry their op_code so
+    failures can be logged by name. OP_IF/OP_NOTIF/OP_ELSE carry the
+    number of instructions to skip when their branch is not taken, which
+    is relative so compiled scripts can be concatenated.
+    OP_ENDIF and OP_NOP* compile to nothing.
+    Raises SyntaxError if the conditionals are unbalanced and ValueError
+    if the cmds are over the limits of check_limits.'''
+    check_limits(cmds)
+    program = []
+    # instructions whose jump still needs to be resolved
+    open_branches = []
+    for cmd in cmds:
+        if type(cmd) != int:
+            program.append((INSTRUCTION_PUSH, None, cmd))
+        elif cmd in (99, 100):
+            open_branches.append(len(program))
+            if cmd == 99:
+                program.append([INSTRUCTION_IF, None, None])
+            else:
+                program.append([INSTRUCTION_NOTIF, None, None])
+        elif cmd == 103:
+            if len(open_branches) < 1:
+                raise SyntaxError('OP_ELSE without OP_IF')
+            # the branch before us resumes right after this OP_ELSE
+            index = open_branches.pop()
+            program[index][2] = len(program) - index
+            open_branches.append(len(program))
+            program.append([INSTRUCTION_ELSE, None, None])
+        elif cmd == 104:
+            if len(open_branches) < 1:
+                raise SyntaxError('OP_ENDIF without OP_IF')
+            index = open_branches.pop()
+            program[index][2] = len(program) - index - 1
+        elif cmd not in OP_CODE_FUNCTIONS:
+            program.append((INSTRUCTION_BAD, None, cmd))
+        elif OP_CODE_FUNCTIONS[cmd] is op_nop:
+            continue
+        elif cmd in (107, 108):
+            # op_toaltstack/op_fromaltstack require the altstack
+            program.append((INSTRUCTION_ALTSTACK, OP_CODE_FUNCTIONS[cmd], cmd))
+        elif cmd in (172, 173, 174, 175):
+            # these are signing operations, they need a sig_hash
+            program.append((INSTRUCTION_SIG, OP_CODE_FUNCTIONS[cmd], cmd))
+        else:
+            program.append((INSTRUCTION_OP, OP_CODE_FUNCTIONS[cmd], cmd))
+    if len(open_branches) > 0:
+        raise SyntaxError('OP_IF without OP_ENDIF')
+    return [tuple(instruction) for instruction in program]
+
+
+def parse_cmds(buffer, offset, end):
+    '''Returns the cmds of the raw script between offset and end of buffer'''
+    # initialize the cmds array
+    cmds = []
+    try:
+        # loop until we've read up to end
+        while offset < end:
+            # get the current byte
+            current_byte = buffer[offset]
+            offset += 1
+            # if the current byte is between 1 and 75 inclusive
+            if current_byte >= 1 and current_byte <= 75:
+                # we have an cmd, the current byte is its length
+                n = current_byte
+            elif current_byte == 76:
+                # op_pushdata1
+                n = buffer[offset]
+                offset += 1
+            elif current_byte == 77:
+                # op_pushdata2
+                n = UINT16.unpack_from(buffer, offset)[0]
+                offset += 2
+            else:
+                # we have an opcode, add it to the list of cmds
+                cmds.append(current_byte)
+                continue
+            # add the next n bytes as an cmd
+            cmds.append(bytes(buffer[offset:offset + n]))
+            offset += n
+    except (IndexError, struct.error):
+        # a push length ran past the end of buffer
+        raise SyntaxError('parsing script failed')
+    if offset != end:
+        raise SyntaxError('parsing script failed')
+    return cmds
+
+
+@lru_cache(maxsize=1024)
+def parse_redeem_script(raw_redeem):
+    '''Parses a serialized RedeemScript (no prepended length).
+    The result is shared between callers so it must not be modified.'''
+    return Script(parse_cmds(raw_redeem, 0, len(raw_redeem)))
+
+
+# number of recent script_to_address results kept
+ADDRESS_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def script_to_address(raw_script_pubkey, testnet=False):
+    '''Takes a serialized ScriptPubKey (no prepended length) and returns
+    the address it pays to, None if it has none or doesn't parse.'''
+    try:
+        script_pubkey = Script(
+            parse_cmds(raw_script_pubkey, 0, len(raw_script_pubkey)))
+    except SyntaxError:
+        return None
+    return script_pubkey.address(testnet)
+
+
+class ScriptProfiler:
+    '''Collects per-opcode counts and timings from Script.evaluate.
+    Use enable_profiling() to install one for the whole process.'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # op_code -> [calls, failures, total seconds, max seconds]
+        self.op_stats = {}
+        self.scripts = 0
+        self.script_bytes = 0
+        self.max_script_bytes = 0
+        self.max_stack_depth = 0
+
+    def record_script(self, script):
+        size = len(script.raw_serialize())
+        self.scripts += 1
+        self.script_bytes += size
+        if size > self.max_script_bytes:
+            self.max_script_bytes = size
+
+    def wrap(self, program):
+        '''Returns program with every op function replaced by one that
+        records its calls into this profiler'''
+        result = []
+        for kind, operation, arg in program:
+            if kind in (INSTRUCTION_OP, INSTRUCTION_ALTSTACK, INSTRUCTION_SIG):
+                operation = self.timed(operation, arg)
+            result.append((kind, operation, arg))
+        return result
+
+    def timed(self, operation, op_code):
+        stats = self.op_stats.setdefault(op_code, [0, 0, 0.0, 0.0])
+
+        def timed_operation(stack, *args):
+            start = perf_counter()
+            result = operation(stack, *args)
+            elapsed = perf_counter() - start
+            stats[0] += 1
+            if not result:
+                stats[1] += 1
+            stats[2] += elapsed
+            if elapsed > stats[3]:
+                stats[3] = elapsed
+            if len(stack) > self.max_stack_depth:
+                self.max_stack_depth = len(stack)
+            return result
+
+        return timed_operation
+
+    def report(self):
+        '''Returns a table of the opcodes sorted by total time'''
+        lines = [
+            'scripts: {} total bytes: {} max bytes: {} max stack depth: {}'.format(
+                self.scripts, self.script_bytes, self.max_script_bytes,
+                self.max_stack_depth),
+            '{:<24}{:>10}{:>10}{:>14}{:>14}'.format(
+                'op', 'calls', 'failures', 'total us', 'max us'),
+        ]
+        rows = sorted(
+            self.op_stats.items(), key=lambda item: item[1][2], reverse=True)
+        for op_code, (calls, failures, total, maximum) in rows:
+            if calls == 0:
+                continue
+            lines.append('{:<24}{:>10}{:>10}{:>14.1f}{:>14.1f}'.format(
+                OP_CODE_NAMES.get(op_code, 'OP_[{}]'.format(op_code)),
+                calls, failures, total * 1e6, maximum * 1e6))
+        return '\n'.join(lines)
+
+
+# the ScriptProfiler Script.evaluate reports to, None when disabled
+PROFILER = None
+
+
+def enable_profiling():
+    '''Starts profiling Script.evaluate and returns the ScriptProfiler'''
+    global PROFILER
+    if PROFILER is None:
+        PROFILER = ScriptProfiler()
+    return PROFILER
+
+
+def disable_profiling():
+    '''Stops profiling and returns the ScriptProfiler that was in use'''
+    global PROFILER
+    profiler = PROFILER
+    PROFILER = None
+    return profiler
+
 
 class Script:
 
@@ -36,6 +299,16 @@ class Script:
             self.cmds = []
         else:
             self.cmds = cmds
+        # cache for compile() and compile_unfolded(), only valid while the
+        # cmds equal this snapshot
+        self._program = None
+        self._unfolded = None
+        self._program_cmds = None
+        # (first instruction, op count) of each script this one was added
+        # from, consensus counts the ops of every script on their own
+        self._segments = [(0, 0)]
+        # the two scripts this one was added from, if any
+        self._parts = None
 
     def __repr__(self):
         result = []
@@ -51,149 +324,318 @@ class Script:
         return ' '.join(result)
 
     def __add__(self, other):
-        return Script(self.cmds + other.cmds)
+        result = Script(self.cmds + other.cmds)
+        # remember the parts so compile() can reuse their programs
+        result._parts = (self, other)
+        return result
 
     @classmethod
     def parse(cls, s):
+        return parse_stream(s, cls.parse_from)
+
+    @classmethod
+    def parse_from(cls, buffer, offset=0):
+        '''Parses the script at offset of buffer, returns it and the offset
+        right after it'''
         # get the length of the entire field
-        length = read_varint(s)
-        # initialize the cmds array
-        cmds = []
-        # initialize the number of bytes we've read to 0
-        count = 0
-        # loop until we've read length bytes
-        while count < length:
-            # get the current byte
-            current = s.read(1)
-            # increment the bytes we've read
-            count += 1
-            # convert the current byte to an integer
-            current_byte = current[0]
-            # if the current byte is between 1 and 75 inclusive
-            if current_byte >= 1 and current_byte <= 75:
-                # we have an cmd set n to be the current byte
-                n = current_byte
-                # add the next n bytes as an cmd
-                cmds.append(s.read(n))
-                # increase the count by n
-                count += n
-            elif current_byte == 76:
-                # op_pushdata1
-                data_length = little_endian_to_int(s.read(1))
-                cmds.append(s.read(data_length))
-                count += data_length + 1
-            elif current_byte == 77:
-                # op_pushdata2
-                data_length = little_endian_to_int(s.read(2))
-                cmds.append(s.read(data_length))
-                count += data_length + 2
-            else:
-                # we have an opcode. set the current byte to op_code
-                op_code = current_byte
-                # add the op_code to the list of cmds
-                cmds.append(op_code)
-        if count != length:
-            raise SyntaxError('parsing script failed')
-        return cls(cmds)
+        length, offset = unpack_varint_from(buffer, offset)
+        end = offset + length
+        return cls(parse_cmds(buffer, offset, end)), end
 
-    def raw_serialize(self):
-        # initialize what we'll send back
-        result = b''
+    def raw_length(self):
+        '''Returns the length of the raw serialization'''
+        # one byte per opcode or push length
+        total = len(self.cmds)
+        for cmd in self.cmds:
+            if type(cmd) != int:
+                length = len(cmd)
+                total += length
+                if length > 75:
+                    # pushdata1 or pushdata2 and their length bytes
+                    if length < 0x100:
+                        total += 1
+                    elif length <= 520:
+                        total += 2
+                    else:
+                        raise ValueError('too long an cmd')
+        return total
+
+    def raw_serialize_into(self, buffer, offset):
+        '''Writes the raw serialization at offset of buffer, returns the
+        offset right after it'''
         # go through each cmd
         for cmd in self.cmds:
             # if the cmd is an integer, it's an opcode
             if type(cmd) == int:
-                # turn the cmd into a single byte integer using int_to_little_endian
-                result += int_to_little_endian(cmd, 1)
+                buffer[offset] = cmd
+                offset += 1
+                continue
+            # otherwise, this is an element
+            # get the length in bytes
+            length = len(cmd)
+            # for large lengths, we have to use a pushdata opcode
+            if length <= 75:
+                buffer[offset] = length
+                offset += 1
+            elif length < 0x100:
+                # 76 is pushdata1
+                buffer[offset] = 76
+                buffer[offset + 1] = length
+                offset += 2
+            elif length <= 520:
+                # 77 is pushdata2
+                buffer[offset] = 77
+                UINT16.pack_into(buffer, offset + 1, length)
+                offset += 3
             else:
-                # otherwise, this is an element
-                # get the length in bytes
-                length = len(cmd)
-                # for large lengths, we have to use a pushdata opcode
-                if length < 75:
-                    # turn the length into a single byte integer
-                    result += int_to_little_endian(length, 1)
-                elif length > 75 and length < 0x100:
-                    # 76 is pushdata1
-                    result += int_to_little_endian(76, 1)
-                    result += int_to_little_endian(length, 1)
-                elif length >= 0x100 and length <= 520:
-                    # 77 is pushdata2
-                    result += int_to_little_endian(77, 1)
-                    result += int_to_little_endian(length, 2)
-                else:
-                    raise ValueError('too long an cmd')
-                result += cmd
-        return result
+                raise ValueError('too long an cmd')
+            buffer[offset:offset + length] = cmd
+            offset += length
+        return offset
+
+    def raw_serialize(self):
+        buffer = bytearray(self.raw_length())
+        self.raw_serialize_into(buffer, 0)
+        return bytes(buffer)
+
+    def serialized_length(self):
+        length = self.raw_length()
+        return varint_size(length) + length
+
+    def serialize_into(self, buffer, offset):
+        '''Writes the serialization (raw serialization prepended with its
+        length) at offset of buffer, returns the offset right after it'''
+        # most scripts are shorter than 0xfd bytes so their length takes
+        # one byte and is only known once they're written
+        end = self.raw_serialize_into(buffer, offset + 1)
+        length = end - offset - 1
+        if length < 0xfd:
+            buffer[offset] = length
+            return end
+        # longer ones are written again after their wider varint
+        offset = pack_varint_into(buffer, offset, length)
+        return self.raw_serialize_into(buffer, offset)
 
     def serialize(self):
-        # get the raw serialization (no prepended length)
-        result = self.raw_serialize()
-        # get the length of the whole thing
-        total = len(result)
-        # encode_varint the total length of the result and prepend
-        return encode_varint(total) + result
+        buffer = bytearray(self.serialized_length())
+        self.serialize_into(buffer, 0)
+        return bytes(buffer)
+
+    def compile_unfolded(self):
+        '''Returns the compiled program of this script (see compile_cmds)
+        without the p2sh folding of compile(), cached until self.cmds is
+        replaced or changed. Scripts added together reuse these programs
+        of their parts.
+        Raises SyntaxError if the conditionals are unbalanced and ValueError
+        if a script is over the limits of check_limits.'''
+        # a snapshot, so that changes made to the cmds list in place are
+        # noticed too
+        cmds = tuple(self.cmds)
+        if cmds == self._program_cmds:
+            return self._unfolded
+        program = None
+        if self._parts is not None:
+            left, right = self._parts
+            if tuple(left.cmds) + tuple(right.cmds) == cmds:
+                try:
+                    left_program = left.compile_unfolded()
+                    right_program = right.compile_unfolded()
+                except SyntaxError:
+                    # a conditional spans both parts
+                    left_program = None
+                if left_program is not None:
+                    program = left_program + right_program
+                    segments = left._segments + [
+                        (start + len(left_program), count)
+                        for start, count in right._segments]
+        if program is None:
+            program = compile_cmds(cmds)
+            segments = [(0, self.op_count())]
+        self._unfolded = program
+        self._program = None
+        self._program_cmds = cmds
+        self._segments = segments
+        return program
+
+    def compile(self):
+        '''Returns the program of compile_unfolded() where a RedeemScript
+        followed by a p2sh ScriptPubKey at the end of the script is folded
+        into one instruction that runs the RedeemScript.
+        Raises SyntaxError if the conditionals are unbalanced and ValueError
+        if a script is over the limits of check_limits.'''
+        program = self.compile_unfolded()
+        if self._program is not None:
+            return self._program
+        # only the whole script is folded, the scriptSig of a combined
+        # script must not skip the ScriptPubKey after it
+        cmds = self._program_cmds
+        if len(cmds) >= 4 and type(cmds[-4]) == bytes \
+                and cmds[-3] == 0xa9 \
+                and type(cmds[-2]) == bytes and len(cmds[-2]) == 20 \
+                and cmds[-1] == 0x87:
+            # a RedeemScript followed by a p2sh ScriptPubKey, fold the
+            # last four cmds into one instruction
+            program = program[:-4]
+            program.append((INSTRUCTION_P2SH, cmds[-2], cmds[-4]))
+        self._program = program
+        return program
 
     def evaluate(self, z):
-        # create a copy as we may need to add to this list if we have a
-        # RedeemScript
-        cmds = self.cmds[:]
+        try:
+            program = self.compile()
+        except (SyntaxError, ValueError) as e:
+            LOGGER.info(e)
+            return False
+        # ops of the running script, executed multisigs add their key count.
+        # The count starts over at the first instruction of each script this
+        # one was added from.
+        segments = self._segments
+        op_count = segments[0][1]
+        segment = 1
+        next_start = segments[1][0] if len(segments) > 1 else -1
+        profiler = PROFILER
+        if profiler is not None:
+            profiler.record_script(self)
+            program = profiler.wrap(program)
         stack = []
         altstack = []
-        while len(cmds) > 0:
-            cmd = cmds.pop(0)
-            if type(cmd) == int:
-                # do what the opcode says
-                operation = OP_CODE_FUNCTIONS[cmd]
-                if cmd in (99, 100):
-                    # op_if/op_notif require the cmds array
-                    if not operation(stack, cmds):
-                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
-                elif cmd in (107, 108):
-                    # op_toaltstack/op_fromaltstack require the altstack
-                    if not operation(stack, altstack):
-                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
-                elif cmd in (172, 173, 174, 175):
-                    # these are signing operations, they need a sig_hash
-                    # to check against
-                    if not operation(stack, z):
-                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
+        # program counter, index of the next instruction to run
+        pc = 0
+        while pc < len(program):
+            if pc == next_start:
+                op_count = segments[segment][1]
+                segment += 1
+                if segment < len(segments):
+                    next_start = segments[segment][0]
                 else:
-                    if not operation(stack):
-                        LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[cmd]))
-                        return False
+                    next_start = -1
+            kind, operation, arg = program[pc]
+            pc += 1
+            if kind == INSTRUCTION_PUSH:
+                stack.append(arg)
+                if len(stack) + len(altstack) > MAX_STACK_SIZE:
+                    LOGGER.info('stack too large')
+                    return False
+            elif kind == INSTRUCTION_OP:
+                if not operation(stack):
+                    LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[arg]))
+                    return False
+                if len(stack) + len(altstack) > MAX_STACK_SIZE:
+                    LOGGER.info('stack too large')
+                    return False
+            elif kind == INSTRUCTION_SIG:
+                if arg in (174, 175) and len(stack) > 0:
+                    # consensus counts each key of a multisig as an op
+                    n = decode_num(stack[-1])
+                    if 0 <= n <= MAX_PUBKEYS_PER_MULTISIG:
+                        op_count += n
+                        if op_count > MAX_OPS_PER_SCRIPT:
+                            LOGGER.info('too many ops: {}'.format(op_count))
+                            return False
+                # signing operations need a sig_hash to check against
+                if not operation(stack, z):
+                    LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[arg]))
+                    return False
+            elif kind == INSTRUCTION_IF or kind == INSTRUCTION_NOTIF:
+                if len(stack) < 1:
+                    LOGGER.info('bad op: {}'.format(
+                        'OP_IF' if kind == INSTRUCTION_IF else 'OP_NOTIF'))
+                    return False
+                # skip to the OP_ELSE/OP_ENDIF if the branch isn't taken
+                if (decode_num(stack.pop()) == 0) == (kind == INSTRUCTION_IF):
+                    pc += arg
+            elif kind == INSTRUCTION_ELSE:
+                # end of the branch that was taken
+                pc += arg
+            elif kind == INSTRUCTION_ALTSTACK:
+                if not operation(stack, altstack):
+                    LOGGER.info('bad op: {}'.format(OP_CODE_NAMES[arg]))
+                    return False
+            elif kind == INSTRUCTION_P2SH:
+                # operation is the h160 and arg the RedeemScript
+                stack.append(arg)
+                if not op_hash160(stack):
+                    return False
+                stack.append(operation)
+                if len(stack) + len(altstack) > MAX_STACK_SIZE:
+                    LOGGER.info('stack too large')
+                    return False
+                if not op_equal(stack):
+                    return False
+                # final result should be a 1
+                if not op_verify(stack):
+                    LOGGER.info('bad p2sh h160')
+                    return False
+                # hashes match! now run the RedeemScript
+                try:
+                    redeem_script = parse_redeem_script(arg)
+                    program = redeem_script.compile()
+                except (SyntaxError, ValueError) as e:
+                    LOGGER.info(e)
+                    return False
+                op_count = redeem_script._segments[0][1]
+                next_start = -1
+                if profiler is not None:
+                    profiler.record_script(redeem_script)
+                    program = profiler.wrap(program)
+                pc = 0
             else:
-                # add the cmd to the stack
-                stack.append(cmd)
-                if len(cmds) == 3 and cmds[0] == 0xa9 \
-                        and type(cmds[1]) == bytes and len(cmds[1]) == 20 \
-                        and cmds[2] == 0x87:
-                    # we execute the next three opcodes
-                    cmds.pop()
-                    h160 = cmds.pop()
-                    cmds.pop()
-                    if not op_hash160(stack):
-                        return False
-                    stack.append(h160)
-                    if not op_equal(stack):
-                        return False
-                    # final result should be a 1
-                    if not op_verify(stack):
-                        LOGGER.info('bad p2sh h160')
-                        return False
-                    # hashes match! now add the RedeemScript
-                    redeem_script = encode_varint(len(cmd)) + cmd
-                    stream = BytesIO(redeem_script)
-                    cmds.extend(Script.parse(stream).cmds)
+                LOGGER.info('bad op: {}'.format(
+                    OP_CODE_NAMES.get(arg, 'OP_[{}]'.format(arg))))
+                return False
         if len(stack) == 0:
             return False
-        if stack.pop() == b'':
+        if encode_element(stack.pop()) == b'':
             return False
         return True
 
+    def check_limits(self):
+        '''Raises ValueError if this script is over the size, element size
+        or op count limits'''
+        check_limits(self.cmds)
+
+    def op_count(self):
+        '''Returns the number of cmds that count towards the op limit'''
+        count = 0
+        for cmd in self.cmds:
+            if type(cmd) == int and cmd > 96:
+                count += 1
+        return count
+
+    def sig_op_count(self, accurate=False):
+        '''Returns the number of signature checks this script can do.
+        OP_CHECKMULTISIG counts as MAX_PUBKEYS_PER_MULTISIG unless accurate
+        is set and it follows an OP_1-OP_16.'''
+        count = 0
+        last_cmd = None
+        for cmd in self.cmds:
+            if type(cmd) == int:
+                if cmd in (172, 173):
+                    count += 1
+                elif cmd in (174, 175):
+                    if accurate and type(last_cmd) == int \
+                            and 0x51 <= last_cmd <= 0x60:
+                        count += last_cmd - 0x50
+                    else:
+                        count += MAX_PUBKEYS_PER_MULTISIG
+            last_cmd = cmd
+        return count
+
+    def p2sh_sig_op_count(self, script_sig):
+        '''Returns the signature checks of the RedeemScript script_sig
+        provides if this is a p2sh ScriptPubKey, 0 otherwise'''
+        if not self.is_p2sh_script_pubkey():
+            return 0
+        elements = push_only_elements(script_sig.cmds)
+        if not elements:
+            return 0
+        try:
+            redeem_script = parse_redeem_script(elements[-1])
+        except (SyntaxError, IndexError) as e:
+            LOGGER.info(e)
+            return 0
+        return redeem_script.sig_op_count(accurate=True)
+
     def is_p2pkh_script_pubkey(self):
         '''Returns whether this follows the
         OP_DUP OP_HASH160 <20 byte hash> OP_EQUALVERIFY OP_CHECKSIG pattern.'''
@@ -208,3 +650,155 @@ class Script:
         return len(self.cmds) == 3 and self.cmds[0] == 0xa9 \
             and type(self.cmds[1]) == bytes and len(self.cmds[1]) == 20 \
             and self.cmds[2] == 0x87
+
+    def is_multisig_script_pubkey(self):
+        '''Returns whether this follows the
+        OP_m <pubkey> ... <pubkey> OP_n OP_CHECKMULTISIG pattern.'''
+        cmds = self.cmds
+        if len(cmds) < 4 or cmds[-1] != 0xae:
+            return False
+        m, n = cmds[0], cmds[-2]
+        if type(m) != int or type(n) != int:
+            return False
+        # OP_1 is 0x51 and OP_16 is 0x60
+        if not 0x51 <= m <= n <= 0x60 or len(cmds) != n - 0x50 + 3:
+            return False
+        for sec in cmds[1:-2]:
+            if type(sec) != bytes:
+                return False
+        return True
+
+    def witness_program(self):
+        '''Returns (version, program) if this follows the
+        <OP_0 to OP_16> <2 to 40 byte program> pattern, None otherwise.'''
+        cmds = self.cmds
+        if len(cmds) != 2 or type(cmds[1]) != bytes \
+                or not 2 <= len(cmds[1]) <= 40:
+            return None
+        if cmds[0] == 0:
+            # version 0 programs are a key hash or a script hash
+            if len(cmds[1]) not in (20, 32):
+                return None
+            return 0, cmds[1]
+        if type(cmds[0]) == int and 0x51 <= cmds[0] <= 0x60:
+            return cmds[0] - 0x50, cmds[1]
+        return None
+
+    def is_p2wpkh_script_pubkey(self):
+        '''Returns whether this follows the OP_0 <20 byte hash> pattern.'''
+        program = self.witness_program()
+        return program is not None and program[0] == 0 \
+            and len(program[1]) == 20
+
+    def is_p2wsh_script_pubkey(self):
+        '''Returns whether this follows the OP_0 <32 byte hash> pattern.'''
+        program = self.witness_program()
+        return program is not None and program[0] == 0 \
+            and len(program[1]) == 32
+
+    def address(self, testnet=False):
+        '''Returns the address paid to by this ScriptPubKey, None if it
+        doesn't follow an address pattern.'''
+        if self.is_p2pkh_script_pubkey():
+            return h160_to_p2pkh_address(self.cmds[2], testnet)
+        if self.is_p2sh_script_pubkey():
+            return h160_to_p2sh_address(self.cmds[1], testnet)
+        program = self.witness_program()
+        if program is not None:
+            return encode_bech32_address(program[0], program[1], testnet)
+        return None
+
+
+def push_only_elements(cmds):
+    '''Returns the elements cmds pushes to the stack if they're all data
+    or OP_0, None otherwise'''
+    elements = []
+    for cmd in cmds:
+        if type(cmd) == bytes:
+            elements.append(cmd)
+        elif cmd == 0:
+            elements.append(b'')
+        else:
+            return None
+    return elements
+
+
+def evaluate_multisig(elements, script_pubkey, z):
+    '''Runs a multisig ScriptPubKey on top of the elements on the stack'''
+    cmds = script_pubkey.cmds
+    stack = elements + [cmds[0] - 0x50]
+    stack.extend(cmds[1:-2])
+    stack.append(cmds[-2] - 0x50)
+    # consensus counts each key of a multisig as an op
+    op_count = script_pubkey.op_count() + cmds[-2] - 0x50
+    if op_count > MAX_OPS_PER_SCRIPT:
+        LOGGER.info('too many ops: {}'.format(op_count))
+        return False
+    if len(stack) > MAX_STACK_SIZE:
+        LOGGER.info('stack too large')
+        return False
+    if not op_checkmultisig(stack, z):
+        LOGGER.info('bad op: OP_CHECKMULTISIG')
+        return False
+    return encode_element(stack[-1]) != b''
+
+
+def evaluate_standard(script_sig, script_pubkey, z):
+    '''Evaluates script_sig + script_pubkey without the interpreter if
+    script_pubkey is p2pkh, bare multisig or p2sh of a multisig and
+    script_sig only pushes data.
+    Returns the same result as (script_sig + script_pubkey).evaluate(z),
+    or None if the scripts don't follow one of these templates.'''
+    elements = push_only_elements(script_sig.cmds)
+    if elements is None:
+        return None
+    if not (script_pubkey.is_p2pkh_script_pubkey()
+            or script_pubkey.is_multisig_script_pubkey()
+            or script_pubkey.is_p2sh_script_pubkey()):
+        return None
+    # the interpreter would refuse scripts over the limits
+    try:
+        script_sig.compile()
+        script_pubkey.compile()
+    except (SyntaxError, ValueError) as e:
+        LOGGER.info(e)
+        return False
+    if script_pubkey.is_p2pkh_script_pubkey():
+        # OP_DUP and the pushed h160 are the most the stack holds
+        if len(elements) + 2 > MAX_STACK_SIZE:
+            LOGGER.info('stack too large')
+            return False
+        if len(elements) < 2:
+            return False
+        # OP_DUP OP_HASH160 <h160> OP_EQUALVERIFY
+        if hash160(elements[-1]) != script_pubkey.cmds[2]:
+            LOGGER.info('bad op: OP_EQUALVERIFY')
+            return False
+        stack = elements[-2:]
+        if not op_checksig(stack, z):
+            LOGGER.info('bad op: OP_CHECKSIG')
+            return False
+        return encode_element(stack[-1]) != b''
+    elif script_pubkey.is_multisig_script_pubkey():
+        return evaluate_multisig(elements, script_pubkey, z)
+    elif script_pubkey.is_p2sh_script_pubkey():
+        # the RedeemScript has to be pushed as data for p2sh to apply
+        if len(elements) == 0 or type(script_sig.cmds[-1]) != bytes:
+            return None
+        raw_redeem = elements.pop()
+        if hash160(raw_redeem) != script_pubkey.cmds[1]:
+            LOGGER.info('bad p2sh h160')
+            return False
+        if len(elements) + 2 > MAX_STACK_SIZE:
+            # the RedeemScript and its h160
+            LOGGER.info('stack too large')
+            return False
+        try:
+            redeem_script = parse_redeem_script(raw_redeem)
+            redeem_script.compile()
+        except (SyntaxError, ValueError) as e:
+            LOGGER.info(e)
+            return False
+        if redeem_script.is_multisig_script_pubkey():
+            return evaluate_multisig(elements, redeem_script, z)
+    return None
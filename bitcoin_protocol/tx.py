@@ -1,17 +1,28 @@
+from collections import OrderedDict
 from io import BytesIO
 
 import json
 import requests
 
+from codec import (
+    pack_bytes_into,
+    pack_varint_into,
+    parse_stream,
+    unpack_varint_from,
+    varint_size,
+    UINT32,
+    UINT64,
+)
 from helper import (
-    encode_varint,
     hash256,
-    int_to_little_endian,
     little_endian_to_int,
-    read_varint,
     SIGHASH_ALL,
 )
-from script import Script
+from script import (
+    evaluate_standard,
+    parse_redeem_script,
+    Script,
+)
 
 
 class TxFetcher:
@@ -69,6 +80,51 @@ class TxFetcher:
             f.write(s)
 
 
+# most signature checks a transaction may ask for
+MAX_TX_SIGOPS = 4000
+
+
+class ScriptCache:
+    '''Remembers inputs that passed Tx.verify_input so they aren't run
+    through the scripts again, e.g. when a block contains transactions
+    that were already verified for the mempool.
+    Only successes are stored, keyed by tx hash, input index and the
+    verification flags in effect. Transactions beyond max_size are evicted
+    least recently used first.'''
+    max_size = 50000
+    # tx hash -> set of (input index, flags)
+    cache = OrderedDict()
+
+    @classmethod
+    def contains(cls, tx_hash, input_index, flags=0):
+        entries = cls.cache.get(tx_hash)
+        if entries is None or (input_index, flags) not in entries:
+            return False
+        cls.cache.move_to_end(tx_hash)
+        return True
+
+    @classmethod
+    def add(cls, tx_hash, input_index, flags=0):
+        entries = cls.cache.get(tx_hash)
+        if entries is None:
+            entries = cls.cache[tx_hash] = set()
+            while len(cls.cache) > cls.max_size:
+                cls.cache.popitem(last=False)
+        else:
+            cls.cache.move_to_end(tx_hash)
+        entries.add((input_index, flags))
+
+    @classmethod
+    def remove(cls, tx_hash):
+        '''Forgets every input of a transaction, e.g. once its block is
+        connected or the previous outputs it was checked against changed'''
+        cls.cache.pop(tx_hash, None)
+
+    @classmethod
+    def clear(cls):
+        cls.cache.clear()
+
+
 class Tx:
 
     def __init__(self, version, tx_ins, tx_outs, locktime, testnet=False):
@@ -106,45 +162,65 @@ class Tx:
         '''Takes a byte stream and parses the transaction at the start
         return a Tx object
         '''
-        # s.read(n) will return n bytes
+        return parse_stream(s, cls.parse_from, testnet)
+
+    @classmethod
+    def parse_from(cls, buffer, offset=0, testnet=False):
+        '''Parses the transaction at offset of buffer, returns it and the
+        offset right after it'''
         # version is an integer in 4 bytes, little-endian
-        version = little_endian_to_int(s.read(4))
-        # num_inputs is a varint, use read_varint(s)
-        num_inputs = read_varint(s)
+        version = UINT32.unpack_from(buffer, offset)[0]
+        # num_inputs is a varint
+        num_inputs, offset = unpack_varint_from(buffer, offset + 4)
         # parse num_inputs number of TxIns
         inputs = []
         for _ in range(num_inputs):
-            inputs.append(TxIn.parse(s))
-        # num_outputs is a varint, use read_varint(s)
-        num_outputs = read_varint(s)
+            tx_in, offset = TxIn.parse_from(buffer, offset)
+            inputs.append(tx_in)
+        # num_outputs is a varint
+        num_outputs, offset = unpack_varint_from(buffer, offset)
         # parse num_outputs number of TxOuts
         outputs = []
         for _ in range(num_outputs):
-            outputs.append(TxOut.parse(s))
+            tx_out, offset = TxOut.parse_from(buffer, offset)
+            outputs.append(tx_out)
         # locktime is an integer in 4 bytes, little-endian
-        locktime = little_endian_to_int(s.read(4))
+        locktime = UINT32.unpack_from(buffer, offset)[0]
         # return an instance of the class (see __init__ for args)
-        return cls(version, inputs, outputs, locktime, testnet=testnet)
+        return cls(version, inputs, outputs, locktime, testnet=testnet), \
+            offset + 4
 
-    def serialize(self):
-        '''Returns the byte serialization of the transaction'''
+    def serialized_length(self):
+        total = 8 + varint_size(len(self.tx_ins)) \
+            + varint_size(len(self.tx_outs))
+        for tx_in in self.tx_ins:
+            total += tx_in.serialized_length()
+        for tx_out in self.tx_outs:
+            total += tx_out.serialized_length()
+        return total
+
+    def serialize_into(self, buffer, offset):
+        '''Writes the serialization at offset of buffer, returns the offset
+        right after it'''
         # serialize version (4 bytes, little endian)
-        result = int_to_little_endian(self.version, 4)
-        # encode_varint on the number of inputs
-        result += encode_varint(len(self.tx_ins))
-        # iterate inputs
+        UINT32.pack_into(buffer, offset, self.version)
+        # the number of inputs, then each input
+        offset = pack_varint_into(buffer, offset + 4, len(self.tx_ins))
         for tx_in in self.tx_ins:
-            # serialize each input
-            result += tx_in.serialize()
-        # encode_varint on the number of outputs
-        result += encode_varint(len(self.tx_outs))
-        # iterate outputs
+            offset = tx_in.serialize_into(buffer, offset)
+        # the number of outputs, then each output
+        offset = pack_varint_into(buffer, offset, len(self.tx_outs))
         for tx_out in self.tx_outs:
-            # serialize each output
-            result += tx_out.serialize()
+            offset = tx_out.serialize_into(buffer, offset)
         # serialize locktime (4 bytes, little endian)
-        result += int_to_little_endian(self.locktime, 4)
-        return result
+        UINT32.pack_into(buffer, offset, self.locktime)
+        return offset + 4
+
+    def serialize(self):
+        '''Returns the byte serialization of the transaction'''
+        buffer = bytearray(self.serialized_length())
+        self.serialize_into(buffer, 0)
+        return bytes(buffer)
 
     def fee(self):
         '''Returns the fee of this transaction in satoshi'''
@@ -162,11 +238,7 @@ class Tx:
     def sig_hash(self, input_index, redeem_script=None):
         '''Returns the integer representation of the hash that needs to get
         signed for index input_index'''
-        # start the serialization with version
-        # use int_to_little_endian in 4 bytes
-        s = int_to_little_endian(self.version, 4)
-        # add how many inputs there are using encode_varint
-        s += encode_varint(len(self.tx_ins))
+        tx_ins = []
         # loop through each input using enumerate, so we have the input index
         for i, tx_in in enumerate(self.tx_ins):
             # if the input index is the one we're signing
@@ -180,29 +252,41 @@ class Tx:
             # Otherwise, the ScriptSig is empty
             else:
                 script_sig = None
-            # add the serialization of the input with the ScriptSig we want
-            s += TxIn(
+            # copy the input with the ScriptSig we want
+            tx_ins.append(TxIn(
                 prev_tx=tx_in.prev_tx,
                 prev_index=tx_in.prev_index,
                 script_sig=script_sig,
                 sequence=tx_in.sequence,
-            ).serialize()
-        # add how many outputs there are using encode_varint
-        s += encode_varint(len(self.tx_outs))
-        # add the serialization of each output
-        for tx_out in self.tx_outs:
-            s += tx_out.serialize()
-        # add the locktime using int_to_little_endian in 4 bytes
-        s += int_to_little_endian(self.locktime, 4)
-        # add SIGHASH_ALL using int_to_little_endian in 4 bytes
-        s += int_to_little_endian(SIGHASH_ALL, 4)
+            ))
+        # serialize the modified transaction followed by SIGHASH_ALL in
+        # 4 bytes, little endian, into one buffer
+        modified = Tx(self.version, tx_ins, self.tx_outs, self.locktime)
+        length = modified.serialized_length()
+        s = bytearray(length + 4)
+        modified.serialize_into(s, 0)
+        UINT32.pack_into(s, length, SIGHASH_ALL)
         # hash256 the serialization
         h256 = hash256(s)
         # convert the result to an integer using int.from_bytes(x, 'big')
         return int.from_bytes(h256, 'big')
 
-    def verify_input(self, input_index):
-        '''Returns whether the input has a valid signature'''
+    def verify_input(self, input_index, flags=0, tx_hash=None):
+        '''Returns whether the input has a valid signature
+        flags are the verification rules in effect and tx_hash can be
+        passed if the caller already has self.hash()'''
+        if tx_hash is None:
+            tx_hash = self.hash()
+        # skip inputs that already passed under the same rules
+        if ScriptCache.contains(tx_hash, input_index, flags):
+            return True
+        if self.evaluate_input(input_index):
+            ScriptCache.add(tx_hash, input_index, flags)
+            return True
+        return False
+
+    def evaluate_input(self, input_index):
+        '''Runs the scripts of the input, bypassing the ScriptCache'''
         # get the relevant input
         tx_in = self.tx_ins[input_index]
         # grab the previous ScriptPubKey
@@ -212,32 +296,55 @@ class Tx:
         if script_pubkey.is_p2sh_script_pubkey():
             # the last cmd in a p2sh is the RedeemScript
             cmd = tx_in.script_sig.cmds[-1]
-            # prepend the length of the RedeemScript using encode_varint
-            raw_redeem = encode_varint(len(cmd)) + cmd
-            # parse the RedeemScript
-            redeem_script = Script.parse(BytesIO(raw_redeem))
+            # parse the RedeemScript, shared with Script.evaluate
+            redeem_script = parse_redeem_script(cmd)
         # otherwise RedeemScript is None
         else:
             redeem_script = None
         # get the signature hash (z)
         # pass the RedeemScript to the sig_hash method
         z = self.sig_hash(input_index, redeem_script)
+        # standard scripts can be checked without the interpreter
+        result = evaluate_standard(tx_in.script_sig, script_pubkey, z)
+        if result is not None:
+            return result
         # combine the current ScriptSig and the previous ScriptPubKey
         combined = tx_in.script_sig + script_pubkey
         # evaluate the combined script
         return combined.evaluate(z)
 
-    def verify(self):
+    def verify(self, flags=0):
         '''Verify this transaction'''
         # check that we're not creating money
         if self.fee() < 0:
             return False
+        # reject transactions that could make us do too many signature
+        # checks before doing any of them
+        if self.sig_op_count() > MAX_TX_SIGOPS:
+            return False
         # check that each input has a valid ScriptSig
+        tx_hash = self.hash()
         for i in range(len(self.tx_ins)):
-            if not self.verify_input(i):
+            if not self.verify_input(i, flags, tx_hash):
                 return False
         return True
 
+    def sig_op_count(self):
+        '''Returns the number of signature checks in the ScriptSigs, the
+        ScriptPubKeys spent and created, and the RedeemScripts (counted
+        accurately) of this transaction'''
+        count = 0
+        spends = not self.is_coinbase()
+        for tx_in in self.tx_ins:
+            count += tx_in.script_sig.sig_op_count()
+            if spends:
+                script_pubkey = tx_in.script_pubkey(self.testnet)
+                count += script_pubkey.sig_op_count()
+                count += script_pubkey.p2sh_sig_op_count(tx_in.script_sig)
+        for tx_out in self.tx_outs:
+            count += tx_out.script_pubkey.sig_op_count()
+        return count
+
     def sign_input(self, input_index, private_key):
         '''Signs the input using the private key'''
         # get the signature hash (z)
@@ -307,28 +414,44 @@ class TxIn:
         '''Takes a byte stream and parses the tx_input at the start
         return a TxIn object
         '''
+        return parse_stream(s, cls.parse_from)
+
+    @classmethod
+    def parse_from(cls, buffer, offset=0):
+        '''Parses the tx_input at offset of buffer, returns it and the offset
+        right after it'''
         # prev_tx is 32 bytes, little endian
-        prev_tx = s.read(32)[::-1]
+        prev_tx = bytes(buffer[offset:offset + 32])[::-1]
         # prev_index is an integer in 4 bytes, little endian
-        prev_index = little_endian_to_int(s.read(4))
-        # use Script.parse to get the ScriptSig
-        script_sig = Script.parse(s)
+        prev_index = UINT32.unpack_from(buffer, offset + 32)[0]
+        # use Script.parse_from to get the ScriptSig
+        script_sig, offset = Script.parse_from(buffer, offset + 36)
         # sequence is an integer in 4 bytes, little-endian
-        sequence = little_endian_to_int(s.read(4))
+        sequence = UINT32.unpack_from(buffer, offset)[0]
         # return an instance of the class (see __init__ for args)
-        return cls(prev_tx, prev_index, script_sig, sequence)
+        return cls(prev_tx, prev_index, script_sig, sequence), offset + 4
 
-    def serialize(self):
-        '''Returns the byte serialization of the transaction input'''
+    def serialized_length(self):
+        return 40 + self.script_sig.serialized_length()
+
+    def serialize_into(self, buffer, offset):
+        '''Writes the serialization at offset of buffer, returns the offset
+        right after it'''
         # serialize prev_tx, little endian
-        result = self.prev_tx[::-1]
+        offset = pack_bytes_into(buffer, offset, self.prev_tx[::-1])
         # serialize prev_index, 4 bytes, little endian
-        result += int_to_little_endian(self.prev_index, 4)
+        UINT32.pack_into(buffer, offset, self.prev_index)
         # serialize the script_sig
-        result += self.script_sig.serialize()
+        offset = self.script_sig.serialize_into(buffer, offset + 4)
         # serialize sequence, 4 bytes, little endian
-        result += int_to_little_endian(self.sequence, 4)
-        return result
+        UINT32.pack_into(buffer, offset, self.sequence)
+        return offset + 4
+
+    def serialize(self):
+        '''Returns the byte serialization of the transaction input'''
+        buffer = bytearray(self.serialized_length())
+        self.serialize_into(buffer, 0)
+        return bytes(buffer)
 
     def fetch_tx(self, testnet=False):
         return TxFetcher.fetch(self.prev_tx.hex(), testnet=testnet)
@@ -368,17 +491,32 @@ class TxOut:
         '''Takes a byte stream and parses the tx_output at the start
         return a TxOut object
         '''
+        return parse_stream(s, cls.parse_from)
+
+    @classmethod
+    def parse_from(cls, buffer, offset=0):
+        '''Parses the tx_output at offset of buffer, returns it and the
+        offset right after it'''
         # amount is an integer in 8 bytes, little endian
-        amount = little_endian_to_int(s.read(8))
-        # use Script.parse to get the ScriptPubKey
-        script_pubkey = Script.parse(s)
+        amount = UINT64.unpack_from(buffer, offset)[0]
+        # use Script.parse_from to get the ScriptPubKey
+        script_pubkey, offset = Script.parse_from(buffer, offset + 8)
         # return an instance of the class (see __init__ for args)
-        return cls(amount, script_pubkey)
+        return cls(amount, script_pubkey), offset
 
-    def serialize(self):
-        '''Returns the byte serialization of the transaction output'''
+    def serialized_length(self):
+        return 8 + self.script_pubkey.serialized_length()
+
+    def serialize_into(self, buffer, offset):
+        '''Writes the serialization at offset of buffer, returns the offset
+        right after it'''
         # serialize amount, 8 bytes, little endian
-        result = int_to_little_endian(self.amount, 8)
+        UINT64.pack_into(buffer, offset, self.amount)
         # serialize the script_pubkey
-        result += self.script_pubkey.serialize()
-        return result
+        return self.script_pubkey.serialize_into(buffer, offset + 8)
+
+    def serialize(self):
+        '''Returns the byte serialization of the transaction output'''
+        buffer = bytearray(self.serialized_length())
+        self.serialize_into(buffer, 0)
+        return bytes(buffer)
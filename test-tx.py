@@ -4,3 +4,15 @@ from bitcoin_protocol.tx import Tx
 script_hex = ('0100000001813f79011acb80925dfe69b3def355fe914bd1d96a3f5f71bf8303c6a989c7d1000000006b483045022100ed81ff192e75a3fd2304004dcadb746fa5e24c5031ccfcf21320b0277457c98f02207a986d955c6e0cb35d446a89d3f56100f4d7f67801c31967743a9c8e10615bed01210349fc4e631e3624a545de3f89f5d8684c7b8138bd94bdd531d2e213bf016b278afeffffff02a135ef01000000001976a914bc3b654dca7e56b04dca18f2566cdaf02e8d9ada88ac99c39800000000001976a9141c4bc762dd5423e332166702cb75f40df79fea1288ac19430600')
 stream = BytesIO(bytes.fromhex(script_hex))
 Tx.parse(stream)
+
+# A ScriptSig ending like a p2sh ScriptPubKey must not skip the
+# ScriptPubKey it is combined with
+from bitcoin_protocol.helper import hash160
+from bitcoin_protocol.script import Script, p2pkh_script, p2sh_script
+
+redeem_script = b"\x51"
+script_sig = Script([redeem_script, 0xA9, hash160(redeem_script), 0x87])
+print((script_sig + p2pkh_script(b"\x11" * 20)).evaluate(1) is False)
+print((script_sig + Script([0x6A])).evaluate(1) is False)
+# while a real p2sh spend still runs its RedeemScript
+print((Script([redeem_script]) + p2sh_script(hash160(redeem_script))).evaluate(1))